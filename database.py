@@ -1,127 +1,564 @@
 # database.py
 import sqlite3
-from sqlalchemy.ext.asyncio import create_async_engine
 from contextlib import closing
 import os
 from dotenv import load_dotenv
 from typing import Optional, Tuple
-import asyncio # Импортируем asyncio для to_thread
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import atexit
+import time
+import queue
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Iterator, Callable, TypeVar
+import logging
+from cachetools import TTLCache
 
-# Импортируем функции шифрования/дешифрования (предполагается, что они есть в security.py)
-# Замените на ваш реальный импорт, если он другой
 try:
-    from security import decrypt_token
+    import fcntl # Только POSIX; на Windows схему создает единственный процесс
 except ImportError:
-    # Заглушка, если security.py не найден или функция называется иначе
-    def decrypt_token(encrypted_token: str) -> str:
-        print("Warning: Using STUB decrypt_token function!")
-        # В реальном коде здесь должна быть ваша логика дешифрования
-        # Эта заглушка просто возвращает то, что получила (НЕБЕЗОПАСНО)
-        return encrypted_token
+    fcntl = None
 
+logger = logging.getLogger(__name__)
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./scheduler.db")
 # Синхронный URL нужен для инициализации таблицы и прямых запросов через sqlite3
 SYNC_DATABASE_PATH = DATABASE_URL.replace("sqlite+aiosqlite:///", "")
 
-# Асинхронный движок для APScheduler и потенциально FastAPI (хотя тут sqlite3)
-# engine = create_async_engine(DATABASE_URL) # Пока не используется напрямую в этом файле
+# Дешифровка токенов и хэширование client_secret - в security.py.
+# Модули импортируют друг друга, поэтому здесь импортируется сам модуль, а функции
+# берутся из него при вызове: from-импорт при цикле падал бы с ImportError,
+# если первым импортирован security.
+import security
+
+# PRAGMA, которые действуют только в рамках соединения и должны выполняться на каждом новом.
+# journal_mode=WAL сохраняется в самом файле БД, но его тоже дешево повторить.
+_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",     # Читатели не блокируются писателем
+    "PRAGMA synchronous=NORMAL",   # В режиме WAL безопасно и без fsync на каждый commit
+    "PRAGMA busy_timeout=5000",    # Ждем блокировку до 5 секунд вместо немедленного SQLITE_BUSY
+    "PRAGMA cache_size=-64000",    # ~64 МБ страничного кэша на соединение
+    "PRAGMA temp_store=memory",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Размер кэша подготовленных выражений sqlite3 на соединение (по умолчанию 128).
+# Работает только потому, что соединения пула живут долго.
+STATEMENT_CACHE_SIZE = 256
+
+# Горячие запросы вынесены в константы: один и тот же текст SQL на каждом вызове
+# попадает в кэш выражений соединения и не разбирается/планируется заново.
+# Никогда не собирайте SQL через f-строки - только параметры "?".
+# В accounts хранится не сам client_secret, а его HMAC (security.hash_client_secret)
+_SQL_SELECT_ACCOUNT = "SELECT id, encrypted_vk_token FROM accounts WHERE client_secret_hash = ?"
+_SQL_SELECT_SECRET_BY_VK_USER = "SELECT client_secret_hash FROM accounts WHERE vk_user_id = ?"
+_SQL_SELECT_TOKEN_BY_ACCOUNT = "SELECT encrypted_vk_token FROM accounts WHERE id = ?"
+_SQL_UPSERT_ACCOUNT = """
+    INSERT INTO accounts (client_secret_hash, vk_user_id, encrypted_vk_token)
+    VALUES (?, ?, ?)
+    ON CONFLICT(vk_user_id) DO UPDATE SET
+        client_secret_hash=excluded.client_secret_hash,
+        encrypted_vk_token=excluded.encrypted_vk_token,
+        created_at=CURRENT_TIMESTAMP
+    RETURNING id
+"""
+# Задачи планировщика по аккаунтам. run_date - UTC ISO-строка фиксированного формата,
+# поэтому сортируется как строка.
+_SQL_INSERT_ACCOUNT_JOB = (
+    "INSERT OR REPLACE INTO account_jobs (account_id, job_id, recipient_id, message_preview, run_date, message) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+_SQL_SELECT_ALL_ACCOUNT_JOBS = (
+    "SELECT account_id, job_id, recipient_id, message_preview, run_date, message FROM account_jobs"
+)
+_SQL_SELECT_ACCOUNT_JOBS = (
+    "SELECT job_id, recipient_id, message_preview, run_date FROM account_jobs "
+    "WHERE account_id = ? ORDER BY run_date"
+)
+_SQL_DELETE_ACCOUNT_JOB = "DELETE FROM account_jobs WHERE job_id = ?"
+_SQL_SELECT_JOB_OWNER = "SELECT account_id FROM account_jobs WHERE job_id = ?"
+
+def _connect(db_path: str = SYNC_DATABASE_PATH, timeout: float = 10, **kwargs) -> sqlite3.Connection:
+    """Открывает соединение с SQLite и применяет к нему PRAGMA производительности."""
+    kwargs.setdefault("cached_statements", STATEMENT_CACHE_SIZE)
+    conn = sqlite3.connect(db_path, timeout=timeout, **kwargs)
+    with closing(conn.cursor()) as cursor:
+        for pragma in _CONNECTION_PRAGMAS:
+            cursor.execute(pragma)
+    return conn
+
+# --- Пулы долгоживущих соединений: 1 писатель + N читателей ---
+# В режиме WAL читатели работают параллельно с единственным писателем, поэтому
+# чтения (аутентификация) идут через пул read-only соединений и не ждут записи,
+# а все записи сериализуются через одно соединение-писатель под блокировкой.
+# Соединения открываются один раз при старте (init_db из lifespan) и закрываются close_db.
+# По умолчанию читателей столько же, сколько ядер.
+READER_POOL_SIZE = int(os.getenv("DB_READER_POOL_SIZE") or os.cpu_count() or 4)
+
+_readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+_readers_opened = 0
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.Lock()
+_pooled_connections: list[sqlite3.Connection] = []
+_pool_lock = threading.Lock()
+
+def _open_reader() -> sqlite3.Connection:
+    """Открывает read-only соединение для пула читателей."""
+    uri = Path(SYNC_DATABASE_PATH).resolve().as_uri() + "?mode=ro"
+    # isolation_level=None - autocommit, без неявных BEGIN для SELECT
+    conn = _connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+def _acquire_reader() -> sqlite3.Connection:
+    """Берет соединение из пула читателей, открывая новое, пока пул не заполнен."""
+    global _readers_opened
+    try:
+        return _readers.get_nowait()
+    except queue.Empty:
+        pass
+    with _pool_lock:
+        can_open = _readers_opened < READER_POOL_SIZE
+        if can_open:
+            _readers_opened += 1
+    if not can_open:
+        return _readers.get() # Пул исчерпан - ждем освобождения соединения
+    try:
+        conn = _open_reader()
+    except sqlite3.Error:
+        with _pool_lock:
+            _readers_opened -= 1
+        raise
+    with _pool_lock:
+        _pooled_connections.append(conn)
+    return conn
+
+@contextmanager
+def _reader() -> Iterator[sqlite3.Connection]:
+    """Выдает соединение-читатель на время блока и возвращает его в пул."""
+    conn = _acquire_reader()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+# Отдельный пул потоков только для работы с БД: запросы не стоят в очереди
+# за прочими блокирующими вызовами в общем executor'е по умолчанию.
+# По потоку на каждого читателя плюс один для писателя.
+_DB_POOL = ThreadPoolExecutor(max_workers=READER_POOL_SIZE + 1, thread_name_prefix="db")
+
+async def _run_in_db_thread(func):
+    """Выполняет синхронную функцию работы с БД в пуле потоков БД."""
+    return await asyncio.get_running_loop().run_in_executor(_DB_POOL, func)
+
+@contextmanager
+def _writer_connection() -> Iterator[sqlite3.Connection]:
+    """Монопольно выдает единственное соединение-писатель."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _connect(check_same_thread=False, isolation_level=None)
+            with _pool_lock:
+                _pooled_connections.append(_writer)
+        yield _writer
+
+T = TypeVar("T")
+WRITE_RETRY_ATTEMPTS = 5
+
+def _is_busy_error(error: sqlite3.OperationalError) -> bool:
+    """Проверяет, что ошибка - это SQLITE_BUSY/"database is locked"."""
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+def _write_transaction(work: Callable[[sqlite3.Cursor], T]) -> T:
+    """
+    Выполняет work(cursor) в транзакции BEGIN IMMEDIATE на соединении-писателе.
+    BEGIN IMMEDIATE берет блокировку записи сразу, без гонки при повышении SHARED -> RESERVED.
+    Если база все же занята (другой процесс), повторяет попытку с экспоненциальной задержкой.
+    """
+    attempt = 0
+    while True:
+        with _writer_connection() as conn:
+            with closing(conn.cursor()) as cursor:
+                try:
+                    cursor.execute("BEGIN IMMEDIATE")
+                    result = work(cursor)
+                    cursor.execute("COMMIT")
+                    return result
+                except BaseException as e:
+                    # Откатываем при любом исключении из work: иначе общий писатель останется
+                    # внутри BEGIN IMMEDIATE с блокировкой записи, и все следующие записи упадут
+                    if conn.in_transaction:
+                        conn.rollback()
+                    if not isinstance(e, sqlite3.OperationalError) or not _is_busy_error(e):
+                        raise
+                    attempt += 1
+                    if attempt >= WRITE_RETRY_ATTEMPTS:
+                        raise
+        # Ждем вне блокировки писателя, чтобы не держать остальных
+        time.sleep(0.01 * 2 ** attempt)
+
+def _warm_up_pool():
+    """Заранее открывает писателя и все соединения пула читателей."""
+    with _writer_connection():
+        pass
+    held = [_acquire_reader() for _ in range(READER_POOL_SIZE)]
+    for conn in held:
+        _readers.put(conn)
+
+# --- Кэш аккаунтов: client_secret -> (account_id, расшифрованный токен) ---
+# Ключ - тот же HMAC client_secret, что хранится в БД: секреты не держатся в памяти процесса,
+# а хэш считается один раз на запрос и для кэша, и для SELECT.
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "120")) # секунды
+_ACCOUNT_CACHE: "TTLCache[str, Tuple[int, str]]" = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+# account_id -> расшифрованный токен: для задач планировщика, у которых есть только account_id
+_ACCOUNT_TOKEN_CACHE: "TTLCache[int, str]" = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+_token_cache_lock = threading.Lock()
+
+def _invalidate_secret_hash(secret_hash: str) -> None:
+    with _token_cache_lock:
+        _ACCOUNT_CACHE.pop(secret_hash, None)
+
+def invalidate_secret(client_secret: str) -> None:
+    """Удаляет закэшированный аккаунт для client_secret (например, после перевыпуска секрета)."""
+    _invalidate_secret_hash(security.hash_client_secret(client_secret))
+
+def get_cached_account_token(account_id: int) -> Optional[str]:
+    """Возвращает закэшированный расшифрованный токен аккаунта или None."""
+    with _token_cache_lock:
+        return _ACCOUNT_TOKEN_CACHE.get(account_id)
+
+def cache_account_token(account_id: int, vk_token: str) -> None:
+    """Кладет расшифрованный токен аккаунта в кэш по account_id."""
+    with _token_cache_lock:
+        _ACCOUNT_TOKEN_CACHE[account_id] = vk_token
+
+@atexit.register
+def close_db() -> None:
+    """
+    Закрывает все соединения пулов (вызывается при остановке приложения и при выходе процесса).
+    Следующее обращение к БД или init_db откроют пулы заново.
+    """
+    global _writer, _readers_opened
+    with _writer_lock, _pool_lock:
+        _writer = None
+        _readers_opened = 0
+        while True:
+            try:
+                _readers.get_nowait()
+            except queue.Empty:
+                break
+        while _pooled_connections:
+            try:
+                _pooled_connections.pop().close()
+            except sqlite3.Error:
+                pass
+
+# Версия схемы в PRAGMA user_version. DDL выполняется только для БД с меньшей версией,
+# поэтому рестарты и воркеры uvicorn не пишут в уже готовую базу.
+SCHEMA_VERSION = 5
+
+@contextmanager
+def _schema_lock(db_path: str) -> Iterator[None]:
+    """Межпроцессная блокировка на время проверки/создания схемы (файл <db>.lock)."""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{db_path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 def init_db():
     """Инициализирует таблицу для хранения client_secret и токенов."""
     db_path = SYNC_DATABASE_PATH
-    print(f"Initializing database at: {db_path}")
+    logger.info("Initializing database at: %s", db_path)
     # Убедимся, что директория существует
     os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
     try:
-        with closing(sqlite3.connect(db_path)) as conn:
+        # isolation_level=None: модуль sqlite3 сам не открывает и не коммитит транзакции,
+        # иначе DDL миграции выполнялся бы в автокоммите
+        with _schema_lock(db_path), closing(_connect(db_path, isolation_level=None)) as conn:
             with closing(conn.cursor()) as cursor:
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS accounts (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        client_secret TEXT UNIQUE NOT NULL,
-                        vk_user_id INTEGER UNIQUE NOT NULL,
-                        encrypted_vk_token TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                # Индексы для ускорения поиска
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_client_secret ON accounts (client_secret)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_vk_user_id ON accounts (vk_user_id)")
-                conn.commit()
-        print("Database 'accounts' table initialized successfully.")
+                cursor.execute("PRAGMA user_version")
+                (version,) = cursor.fetchone()
+                if version >= SCHEMA_VERSION:
+                    logger.info("Database schema is up to date (version %s).", version)
+                else:
+                    # DDL в SQLite транзакционен: все шаги и новая user_version фиксируются вместе.
+                    # Если процесс упадет посередине, при следующем старте миграция начнется
+                    # заново с прежней версии, а не наткнется на уже добавленный/переименованный столбец.
+                    cursor.execute("BEGIN IMMEDIATE")
+                    try:
+                        _migrate_schema(cursor, version)
+                        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                        cursor.execute("COMMIT")
+                    except BaseException:
+                        if conn.in_transaction:
+                            conn.rollback()
+                        raise
+                    logger.info("Database 'accounts' table initialized successfully.")
+        _warm_up_pool()
     except sqlite3.Error as e:
-        print(f"Error initializing database: {e}")
+        logger.error("Error initializing database: %s", e)
         raise
 
+def _migrate_schema(cursor: sqlite3.Cursor, version: int) -> None:
+    """
+    Доводит схему с версии version до SCHEMA_VERSION. Вызывается из init_db внутри
+    транзакции вместе с записью user_version. Шаги 1-2 идемпотентны: базы до версионирования
+    имеют user_version 0.
+    """
+    if version < 1:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_secret TEXT UNIQUE NOT NULL,
+                vk_user_id INTEGER UNIQUE NOT NULL,
+                encrypted_vk_token TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+    if version < 2:
+        # Индекс задач планировщика по аккаунтам, чтобы список задач
+        # не требовал распаковки задач APScheduler
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS account_jobs (
+                job_id TEXT PRIMARY KEY,
+                account_id INTEGER NOT NULL,
+                recipient_id TEXT NOT NULL,
+                message_preview TEXT NOT NULL,
+                run_date TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_account_jobs_account ON account_jobs (account_id, run_date)")
+    if version < 3:
+        # account_jobs - постоянное хранилище задач (планировщик держит их в памяти),
+        # поэтому строке нужен полный текст сообщения
+        cursor.execute("ALTER TABLE account_jobs ADD COLUMN message TEXT")
+    if version < 4:
+        # UNIQUE на client_secret и vk_user_id уже создает B-tree индексы (sqlite_autoindex_*);
+        # прежние явные индексы их дублировали и лишь удваивали запись при каждом upsert
+        cursor.execute("DROP INDEX IF EXISTS idx_client_secret")
+        cursor.execute("DROP INDEX IF EXISTS idx_vk_user_id")
+    if version < 5:
+        # Вместо client_secret храним его HMAC; UNIQUE-индекс переименованного столбца сохраняется.
+        # Переименование и пересчет идут в транзакции миграции. Столбец мог быть уже переименован
+        # прежней версией, которая выполняла RENAME в автокоммите и упала до записи user_version:
+        # тогда в client_secret_hash еще лежат исходные секреты, и их нужно только захэшировать.
+        cursor.execute("PRAGMA table_info(accounts)")
+        if "client_secret" in {column[1] for column in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE accounts RENAME COLUMN client_secret TO client_secret_hash")
+        cursor.execute("SELECT id, client_secret_hash FROM accounts")
+        cursor.executemany(
+            "UPDATE accounts SET client_secret_hash = ? WHERE id = ?",
+            [(security.hash_client_secret(secret), account_id) for account_id, secret in cursor.fetchall()],
+        )
+
 # --- ДОБАВЛЕНЫ ФУНКЦИИ ДЛЯ ПОЛУЧЕНИЯ ДАННЫХ ---
 
-async def get_account_id_by_secret(client_secret: str) -> Optional[int]:
+async def resolve_account(client_secret: str) -> Optional[Tuple[int, str]]:
     """
-    Асинхронно получает ID аккаунта (primary key) по client_secret.
-    Возвращает ID или None, если секрет не найден.
-    Использует синхронный вызов в потоке.
+    Асинхронно получает по client_secret пару (account_id, расшифрованный VK токен)
+    одним запросом к БД и кэширует ее.
+    Возвращает None, если секрет не найден, произошла ошибка БД или токен не расшифровывается.
     """
     if not client_secret:
         return None
 
-    def db_query():
+    # Горячий путь: аккаунт уже в кэше - ни потока, ни SQLite, ни расшифровки
+    secret_hash = security.hash_client_secret(client_secret)
+    with _token_cache_lock:
+        cached = _ACCOUNT_CACHE.get(secret_hash)
+    if cached is not None:
+        return cached
+
+    def db_query_and_decrypt() -> Optional[Tuple[int, str]]:
         try:
-            with closing(sqlite3.connect(SYNC_DATABASE_PATH, timeout=10)) as conn: # Добавлен таймаут
+            with _reader() as conn:
                 with closing(conn.cursor()) as cursor:
-                    cursor.execute("SELECT id FROM accounts WHERE client_secret = ?", (client_secret,))
+                    cursor.execute(_SQL_SELECT_ACCOUNT, (secret_hash,))
                     result = cursor.fetchone()
-                    return result[0] if result else None
         except sqlite3.Error as e:
-            print(f"Database error in get_account_id_by_secret: {e}")
-            return None # Возвращаем None при ошибке БД
+            logger.error("Database error resolving account for secret ending ...%s: %s", client_secret[-4:], e)
+            return None # Ошибка БД
 
-    account_id = await asyncio.to_thread(db_query)
-    return account_id
+        if not result:
+            return None # Секрет не найден
+        account_id, encrypted_token = result
+        if not encrypted_token:
+            return None
+
+        try:
+            # Дешифровка происходит здесь, после получения из БД
+            decrypted = security.decrypt_token(encrypted_token)
+        except Exception as e:
+            # Ловим возможные ошибки дешифровки
+            logger.error("Error decrypting token for secret ending ...%s: %s", client_secret[-4:], e)
+            return None
+        return (account_id, decrypted) if decrypted else None
+
+    # Запускаем синхронную функцию БД + дешифровки в отдельном потоке
+    account = await _run_in_db_thread(db_query_and_decrypt)
+    if account is not None:
+        with _token_cache_lock:
+            _ACCOUNT_CACHE[secret_hash] = account
+            _ACCOUNT_TOKEN_CACHE[account[0]] = account[1]
+    return account
+
+
+async def get_account_id_by_secret(client_secret: str) -> Optional[int]:
+    """
+    Асинхронно получает ID аккаунта (primary key) по client_secret.
+    Возвращает ID или None, если секрет не найден.
+    """
+    account = await resolve_account(client_secret)
+    return account[0] if account else None
 
 
 async def get_decrypted_token_by_secret(client_secret: str) -> Optional[str]:
     """
-    Асинхронно получает ЗАШИФРОВАННЫЙ токен по client_secret,
-    ДЕШИФРУЕТ его и возвращает.
-    Возвращает расшифрованный токен или None, если секрет не найден или ошибка дешифровки.
-    Использует синхронный вызов в потоке для доступа к БД.
+    Асинхронно получает расшифрованный VK токен по client_secret.
+    Возвращает токен или None, если секрет не найден или ошибка дешифровки.
     """
-    if not client_secret:
-        return None
+    account = await resolve_account(client_secret)
+    return account[1] if account else None
+
+async def upsert_account(vk_user_id: int, client_secret: str, encrypted_token: str,
+                         vk_token: Optional[str] = None) -> int:
+    """
+    Асинхронно создает аккаунт или обновляет client_secret и токен существующего (по vk_user_id).
+    Возвращает ID аккаунта (из RETURNING, без повторного SELECT).
+    Запись идет через единственное соединение-писатель; ошибки sqlite3 пробрасываются вызывающему.
+    В БД сохраняется HMAC client_secret, а не сам секрет.
+    Прежний client_secret этого пользователя удаляется из кэша токенов. Если передан
+    расшифрованный vk_token, новый секрет сразу кладется в кэш, и первый запрос с ним не идет в БД;
+    иначе токен аккаунта сбрасывается из кэша по account_id.
+    """
+    secret_hash = security.hash_client_secret(client_secret)
+
+    def db_upsert(cursor: sqlite3.Cursor) -> Tuple[int, Optional[str]]:
+        # Запоминаем хэш заменяемого секрета, чтобы сбросить его из кэша
+        cursor.execute(_SQL_SELECT_SECRET_BY_VK_USER, (vk_user_id,))
+        previous = cursor.fetchone()
+        # INSERT ... ON CONFLICT для атомарного обновления или вставки
+        cursor.execute(_SQL_UPSERT_ACCOUNT, (secret_hash, vk_user_id, encrypted_token))
+        (account_id,) = cursor.fetchone()
+        return account_id, previous[0] if previous else None
+
+    account_id, previous_hash = await _run_in_db_thread(lambda: _write_transaction(db_upsert))
+    if previous_hash:
+        _invalidate_secret_hash(previous_hash)
+    with _token_cache_lock:
+        if vk_token:
+            _ACCOUNT_CACHE[secret_hash] = (account_id, vk_token)
+            _ACCOUNT_TOKEN_CACHE[account_id] = vk_token
+        else:
+            # Токен сменился, а открытого значения нет - задачи прочитают его из БД
+            _ACCOUNT_TOKEN_CACHE.pop(account_id, None)
+    return account_id
+
+def get_encrypted_token(account_id: int) -> Optional[str]:
+    """
+    Синхронно возвращает зашифрованный VK токен аккаунта или None, если аккаунта нет.
+    Читает через пул соединений-читателей; ошибки sqlite3 пробрасываются вызывающему.
+    """
+    with _reader() as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(_SQL_SELECT_TOKEN_BY_ACCOUNT, (account_id,))
+            result = cursor.fetchone()
+    return result[0] if result else None
+
+# --- Задачи планировщика по аккаунтам (таблица account_jobs) ---
+# Постоянная копия задач: планировщик держит их в памяти и восстанавливает отсюда при старте.
+# Список задач пользователя читается отсюда одним запросом по индексу.
+AccountJobRow = Tuple[int, str, str, str, Optional[str], Optional[str]] # account_id, job_id, recipient_id, message_preview, run_date, message
+
+async def add_account_jobs(rows: list[AccountJobRow]) -> None:
+    """Асинхронно сохраняет задачи в account_jobs одной транзакцией."""
+    await _run_in_db_thread(lambda: _write_transaction(lambda cursor: cursor.executemany(_SQL_INSERT_ACCOUNT_JOB, rows)))
+
+def _delete_account_jobs(job_ids: list[str]) -> None:
+    """Удаляет задачи из account_jobs одной транзакцией (синхронно)."""
+    _write_transaction(lambda cursor: cursor.executemany(_SQL_DELETE_ACCOUNT_JOB, [(job_id,) for job_id in job_ids]))
+
+async def delete_account_jobs(job_ids: list[str]) -> None:
+    """Асинхронно удаляет задачи из account_jobs."""
+    await _run_in_db_thread(lambda: _delete_account_jobs(job_ids))
 
-    def db_query_and_decrypt():
-        encrypted_token: Optional[str] = None
+def delete_account_jobs_in_background(job_ids: list[str]) -> None:
+    """
+    Удаляет задачи из account_jobs в пуле потоков БД, не дожидаясь результата.
+    Для хранилища задач планировщика, которое вызывается синхронно из цикла событий.
+    """
+    def run():
         try:
-            with closing(sqlite3.connect(SYNC_DATABASE_PATH, timeout=10)) as conn:
-                with closing(conn.cursor()) as cursor:
-                    cursor.execute("SELECT encrypted_vk_token FROM accounts WHERE client_secret = ?", (client_secret,))
-                    result = cursor.fetchone()
-                    if result:
-                        encrypted_token = result[0]
-                    else:
-                        return None # Секрет не найден
+            _delete_account_jobs(job_ids)
         except sqlite3.Error as e:
-            print(f"Database error fetching token for secret ending ...{client_secret[-4:]}: {e}")
-            return None # Ошибка БД
+            logger.error("Database error removing jobs %s from account_jobs: %s", job_ids, e)
 
-        if encrypted_token:
-            try:
-                # Дешифровка происходит здесь, после получения из БД
-                decrypted = decrypt_token(encrypted_token)
-                return decrypted
-            except Exception as e:
-                # Ловим возможные ошибки дешифровки
-                print(f"Error decrypting token for secret ending ...{client_secret[-4:]}: {e}")
+    if job_ids:
+        _DB_POOL.submit(run)
+
+async def get_account_jobs(account_id: int) -> list[Tuple[str, str, str, Optional[str]]]:
+    """
+    Асинхронно возвращает задачи аккаунта (job_id, recipient_id, message_preview, run_date),
+    отсортированные по времени запуска. Ошибки sqlite3 пробрасываются вызывающему.
+    """
+    def db_select() -> list[Tuple[str, str, str, Optional[str]]]:
+        with _reader() as conn:
+            with closing(conn.cursor()) as cursor:
+                cursor.execute(_SQL_SELECT_ACCOUNT_JOBS, (account_id,))
+                return cursor.fetchall()
+
+    return await _run_in_db_thread(db_select)
+
+async def get_account_job_owner(job_id: str) -> Optional[int]:
+    """
+    Асинхронно возвращает account_id владельца задачи по индексу account_jobs
+    или None, если такой задачи нет. Ошибки sqlite3 пробрасываются вызывающему.
+    """
+    def db_select() -> Optional[int]:
+        with _reader() as conn:
+            with closing(conn.cursor()) as cursor:
+                cursor.execute(_SQL_SELECT_JOB_OWNER, (job_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+
+    return await _run_in_db_thread(db_select)
+
+def load_account_jobs() -> list[AccountJobRow]:
+    """Синхронно возвращает все задачи из account_jobs (для восстановления планировщика при старте)."""
+    with _reader() as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(_SQL_SELECT_ALL_ACCOUNT_JOBS)
+            return cursor.fetchall()
+
+def get_legacy_scheduler_jobs() -> Optional[list[Tuple[str, bytes]]]:
+    """
+    Синхронно возвращает (id, job_state) из таблицы apscheduler_jobs прежнего SQLAlchemyJobStore
+    или None, если такой таблицы нет.
+    """
+    with _reader() as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'apscheduler_jobs'")
+            if cursor.fetchone() is None:
                 return None
-        else:
-            # Это не должно произойти, если fetchone вернул результат, но на всякий случай
-            return None
+            cursor.execute("SELECT id, job_state FROM apscheduler_jobs")
+            return cursor.fetchall()
 
-    # Запускаем синхронную функцию БД + дешифровки в отдельном потоке
-    decrypted_token = await asyncio.to_thread(db_query_and_decrypt)
-    return decrypted_token
+def import_legacy_scheduler_jobs(rows: list[AccountJobRow]) -> None:
+    """Синхронно сохраняет перенесенные задачи в account_jobs и удаляет apscheduler_jobs одной транзакцией."""
+    def db_import(cursor: sqlite3.Cursor) -> None:
+        cursor.executemany(_SQL_INSERT_ACCOUNT_JOB, rows)
+        cursor.execute("DROP TABLE IF EXISTS apscheduler_jobs")
+
+    _write_transaction(db_import)
 
 # Вызываем инициализацию при старте приложения через lifespan в main_server.py
 # init_db()
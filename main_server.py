@@ -1,15 +1,20 @@
 # main_server.py
-from fastapi import FastAPI, Depends, HTTPException, status, Request, Header, Query # Добавлены Header, Query
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response, Header, Query # Добавлены Header, Query
+from fastapi.responses import ORJSONResponse # orjson сериализует ответы в разы быстрее stdlib json
+from fastapi.middleware.gzip import GZipMiddleware
 import uvicorn
 from contextlib import asynccontextmanager
-from datetime import datetime, timezone
-import uuid
+from datetime import datetime, timezone, timedelta
+import secrets
+import asyncio
+import weakref
 import logging
+import os
+import sys
 import sqlite3 # Нужен для обработки ошибок IntegrityError
-from contextlib import closing
-import asyncio # Нужен для asyncio.to_thread
-from typing import Optional, List # Добавлена List
+from typing import Optional, List, Tuple # Добавлена List
+from cachetools import TTLCache
+from apscheduler.jobstores.base import JobLookupError
 
 # --- Модули вашего проекта ---
 import database
@@ -22,54 +27,68 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Зависимость для аутентификации по заголовку "Authorization: Secret <token>" ---
+# Константы горячего пути аутентификации, чтобы не создавать их на каждый запрос
+_HTTP_401 = status.HTTP_401_UNAUTHORIZED
+_AUTH_HEADERS = {"WWW-Authenticate": "Secret"}
+
+def _unauthorized(detail: str) -> HTTPException:
+    """Создает HTTPException 401 со схемой аутентификации Secret."""
+    return HTTPException(status_code=_HTTP_401, detail=detail, headers=_AUTH_HEADERS)
+
 # Эта зависимость получает ДЕШИФРОВАННЫЙ токен VK
-async def get_vk_token_from_secret(authorization: Optional[str] = Header(None)) -> str:
+async def get_vk_token_from_secret(request: Request, authorization: Optional[str] = Header(None)) -> str:
     """
     Проверяет заголовок Authorization, извлекает client_secret,
     получает соответствующий зашифрованный токен VK из БД, дешифрует его и возвращает.
+    ID аккаунта сохраняется в request.state.account_id, чтобы эндпоинтам не нужен был второй запрос.
     """
     if authorization is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Authorization header missing",
-            headers={"WWW-Authenticate": "Secret"},
-        )
-
-    parts = authorization.split()
-    if len(parts) != 2 or parts[0].lower() != "secret":
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid Authorization header format. Expected 'Secret <your_client_secret>'",
-            headers={"WWW-Authenticate": "Secret"},
-        )
-
-    client_secret = parts[1]
-    decrypted_token = await database.get_decrypted_token_by_secret(client_secret)
-
-    if decrypted_token is None:
-        logger.warning(f"Authentication failed: Invalid or unknown client secret provided (ends with ...{client_secret[-4:]})")
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid client secret",
-            headers={"WWW-Authenticate": "Secret"},
-        )
+        raise _unauthorized("Authorization header missing")
+
+    # partition вместо split(): один кортеж вместо списка подстрок
+    scheme, sep, client_secret = authorization.partition(' ')
+    if not sep or scheme.lower() != "secret" or not client_secret or ' ' in client_secret:
+        raise _unauthorized("Invalid Authorization header format. Expected 'Secret <your_client_secret>'")
+    # Заведомо некорректный секрет не должен доходить до пула потоков и SQLite
+    if not security.is_well_formed_secret(client_secret):
+        raise _unauthorized("Invalid client secret")
+
+    account = await database.resolve_account(client_secret)
+
+    if account is None:
+        if logger.isEnabledFor(logging.WARNING):
+            logger.warning(f"Authentication failed: Invalid or unknown client secret provided (ends with ...{client_secret[-4:]})")
+        raise _unauthorized("Invalid client secret")
     # Можно добавить проверку валидности токена здесь, если нужно быть уверенным
     # user_id = await vk_api.validate_vk_token(decrypted_token)
     # if user_id is None:
     #     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="VK token associated with secret is invalid or expired")
 
-    logger.info(f"Authentication successful for secret ending with ...{client_secret[-4:]}")
+    account_id, decrypted_token = account
+    request.state.account_id = account_id
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Authentication successful for secret ending with ...{client_secret[-4:]}")
     return decrypted_token
 
 # --- Менеджер контекста Lifespan ---
+SINGLE_WORKER_ERROR = "WEB_CONCURRENCY > 1 is not supported: scheduled jobs are kept in process memory and would run once per worker."
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Код, выполняемый перед запуском приложения
     logger.info("Starting application lifespan...")
-    database.init_db() # Инициализируем БД
+    # Задачи планировщика живут в памяти процесса: каждый воркер восстановил бы из account_jobs
+    # свою копию всех задач, сообщения уходили бы по разу на воркер, а DELETE удалял бы задачу
+    # только в одном из них. Поэтому приложение работает в одном процессе
+    # (uvicorn берет число воркеров по умолчанию из той же переменной WEB_CONCURRENCY).
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        raise RuntimeError(SINGLE_WORKER_ERROR)
+    database.init_db() # Инициализируем БД и открываем пул соединений (1 писатель + N читателей)
     sched = scheduler.init_scheduler() # Инициализируем планировщик
     try:
         if not sched.running: # Проверяем, не запущен ли уже (на случай HMR)
+            scheduler.restore_jobs() # Задачи хранятся в памяти - восстанавливаем их из account_jobs
             sched.start() # Запускаем планировщик
             logger.info("Scheduler started.")
         else:
@@ -78,25 +97,32 @@ async def lifespan(app: FastAPI):
         logger.error(f"Failed to start scheduler: {e}", exc_info=True)
         # Решить, должно ли приложение падать, если планировщик не стартовал
         # raise RuntimeError("Scheduler failed to start") from e
+    vk_api.warm_up() # Соединение с VK открывается в фоне, до первого запроса
     yield
     # Код, выполняемый при остановке приложения
     logger.info("Shutting down application lifespan...")
     if sched and sched.running:
         sched.shutdown()
         logger.info("Scheduler shut down.")
+    await vk_api.shutdown() # Закрываем общий HTTP-клиент VK после остановки задач
+    database.close_db() # Закрываем пул соединений SQLite после остановки задач
 
 # --- Инициализация FastAPI ---
 app = FastAPI(
     title="VK Scheduler API",
     description="API for scheduling VK messages",
     version="1.0.0",
-    lifespan=lifespan # Используем новый менеджер контекста lifespan
+    lifespan=lifespan, # Используем новый менеджер контекста lifespan
+    default_response_class=ORJSONResponse
 )
+# Списки задач и диалогов хорошо сжимаются (повторяющиеся ключи, метки времени);
+# мелкие ответы отдаем как есть
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # --- Обработчики ошибок ---
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail},
     )
@@ -104,7 +130,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception during request to {request.url}: {exc}", exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={"detail": "An internal server error occurred. Please check server logs."},
     )
@@ -133,28 +159,12 @@ async def link_vk_account(request: models.LinkAccountRequest):
     encrypted_token = security.encrypt_token(request.vk_access_token) # Шифруем перед сохранением
 
     try:
-        # Используем синхронный доступ к SQLite в отдельном потоке
-        def db_insert_or_update():
-            try:
-                with closing(sqlite3.connect(database.SYNC_DATABASE_PATH, timeout=10)) as conn:
-                    with closing(conn.cursor()) as cursor:
-                        # Используем INSERT ... ON CONFLICT для атомарного обновления или вставки
-                        cursor.execute("""
-                            INSERT INTO accounts (client_secret, vk_user_id, encrypted_vk_token)
-                            VALUES (?, ?, ?)
-                            ON CONFLICT(vk_user_id) DO UPDATE SET
-                                client_secret=excluded.client_secret,
-                                encrypted_vk_token=excluded.encrypted_vk_token,
-                                created_at=CURRENT_TIMESTAMP
-                            """, (client_secret, vk_user_id, encrypted_token))
-                        conn.commit()
-                        logger.info(f"Successfully linked/updated account for vk_user_id: {vk_user_id}")
-            except sqlite3.Error as e:
-                # Ловим ошибки SQLite внутри потока и пробрасываем их
-                logger.error(f"Database error during insert/update for vk_user_id {vk_user_id}: {e}")
-                raise # Пробросить ошибку, чтобы ее поймал внешний try...except
-
-        await asyncio.to_thread(db_insert_or_update) # Выполняем синхронный код в потоке
+        # Запись идет через соединение-писатель пула в отдельном потоке
+        # Передаем и открытый токен: новый секрет сразу попадает в кэш аккаунтов
+        account_id = await database.upsert_account(
+            vk_user_id, client_secret, encrypted_token, vk_token=request.vk_access_token
+        )
+        logger.info(f"Successfully linked/updated account {account_id} for vk_user_id: {vk_user_id}")
 
     except sqlite3.Error as e: # Ловим ошибки SQLite, проброшенные из потока
         logger.error(f"Database operation failed for vk_user_id {vk_user_id}: {e}", exc_info=True)
@@ -167,6 +177,59 @@ async def link_vk_account(request: models.LinkAccountRequest):
     return models.LinkAccountResponse(client_secret=client_secret)
 
 
+def _run_date_for(request: models.ScheduleRequest, now: datetime) -> datetime:
+    """
+    Время запуска задачи в UTC. Бросает ValueError, если оно не в будущем
+    (с запасом в пару секунд, чтобы избежать гонки состояний при мгновенном планировании).
+    """
+    # scheduled_at уже разобран и проверен на наличие таймзоны моделью (AwareDatetime).
+    # Приводим к datetime.timezone.utc: tzinfo от Pydantic не должен попадать в задачу планировщика.
+    run_date_dt = request.scheduled_at.astimezone(timezone.utc)
+    if run_date_dt <= now + timedelta(seconds=2):
+        raise ValueError("Scheduled time must be at least a few seconds in the future")
+    return run_date_dt
+
+def _message_job_row(account_id: int, request: models.ScheduleRequest, run_date_dt: datetime) -> database.AccountJobRow:
+    """Строка account_jobs для новой задачи отправки сообщения."""
+    # ID вида "<account_id>:<12 hex>": владелец задачи виден из самого ID (см. _job_owner_from_id),
+    # 48 случайных бит достаточно для уникальности в пределах аккаунта
+    job_id = f"{account_id}:{secrets.token_hex(6)}" # Генерируем уникальный ID для задачи
+    return (
+        account_id,
+        job_id,
+        request.recipient_id,
+        scheduler.message_preview(request.message), # Считаем один раз, а не при каждом GET
+        scheduler.format_run_time(run_date_dt),
+        request.message,
+    )
+
+async def _schedule_jobs(sched, rows: list[database.AccountJobRow]) -> None:
+    """
+    Сохраняет задачи в account_jobs одной транзакцией, затем добавляет их в планировщик (в память).
+    При ошибке откатывает и то, и другое.
+    """
+    await database.add_account_jobs(rows)
+    try:
+        for row in rows:
+            scheduler.add_message_job(row)
+    except Exception:
+        for row in rows:
+            try:
+                sched.remove_job(row[1])
+            except JobLookupError:
+                pass
+        await database.delete_account_jobs([row[1] for row in rows])
+        raise
+
+
+def _job_owner_from_id(job_id: str) -> Optional[int]:
+    """account_id из префикса ID задачи ("<account_id>:<hex>") или None для ID старого формата."""
+    prefix, sep, _ = job_id.partition(':')
+    if sep and prefix.isascii() and prefix.isdigit():
+        return int(prefix)
+    return None
+
+
 @app.post("/api/schedules",
           response_model=models.ScheduleResponse, # Должна быть определена в models.py
           summary="Schedule a Message",
@@ -188,38 +251,16 @@ async def schedule_message(
          logger.error("Scheduler is not running or not initialized.")
          raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Scheduler service is unavailable")
 
+    # Убедимся, что время в будущем (с небольшим запасом)
     try:
-        # Парсим время из ISO строки и конвертируем в UTC datetime object
-        run_date_dt = datetime.fromisoformat(request.scheduled_at.replace('Z', '+00:00'))
-        run_date_dt = run_date_dt.astimezone(timezone.utc) # Убедимся, что timezone=UTC
-
-        # Убедимся, что время в будущем (с небольшим запасом)
-        # Добавляем пару секунд, чтобы избежать гонки состояний при мгновенном планировании
-        if run_date_dt <= datetime.now(timezone.utc) + timedelta(seconds=2):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Scheduled time must be at least a few seconds in the future")
-
+        run_date_dt = _run_date_for(request, datetime.now(timezone.utc))
     except ValueError as e:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid scheduled_at format: {e}")
-
-    job_id = str(uuid.uuid4()) # Генерируем уникальный ID для задачи
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
     try:
-        sched.add_job(
-            scheduler.schedule_vk_message_job, # Функция, которая будет выполнена
-            trigger='date', # Запуск один раз в указанную дату
-            run_date=run_date_dt, # Передаем datetime объект (уже в UTC)
-            id=job_id,
-            name=f"VKMsg_{account_id}_{request.recipient_id}_{job_id[:8]}", # Имя для логов
-            replace_existing=False, # Не заменять, если ID уже есть (маловероятно)
-            misfire_grace_time=60, # Время (в сек), в течение которого задача может быть запущена после просрочки
-            # Передаем аргументы в функцию задачи schedule_vk_message_job
-            kwargs={
-                'account_id': account_id, # ID аккаунта из нашей БД
-                'recipient_id': request.recipient_id,
-                'message': request.message,
-                'job_id': job_id # Передаем ID самой задаче для логирования
-            }
-        )
+        row = _message_job_row(account_id, request, run_date_dt)
+        await _schedule_jobs(sched, [row])
+        job_id = row[1]
         logger.info(f"Scheduled job {job_id} for account {account_id} at {run_date_dt}")
     except Exception as e:
         logger.error(f"Error adding job to scheduler: {e}", exc_info=True)
@@ -229,6 +270,55 @@ async def schedule_message(
     return models.ScheduleResponse(job_id=job_id, message="Task scheduled successfully") # Модель ответа должна поддерживать message
 
 
+@app.post("/api/schedules/batch",
+          response_model=models.ScheduleBatchResponse,
+          summary="Schedule Messages in Batch",
+          description=f"Schedules up to {models.MAX_SCHEDULE_BATCH} messages in one request. Items are validated like POST /api/schedules: "
+                      "an invalid item rejects the whole batch (422). Items whose scheduled time is not in the future are reported individually.",
+          status_code=status.HTTP_202_ACCEPTED,
+          responses={
+              401: {"model": models.ErrorResponse, "description": "Invalid client secret"},
+              500: {"model": models.ErrorResponse, "description": "Scheduler or Internal Error"}
+          })
+async def schedule_messages_batch(
+    request: models.ScheduleBatchRequest,
+    account_id: int = Depends(security.get_account_id_from_secret)
+):
+    """
+    Планирует несколько сообщений: одна аутентификация и одна транзакция БД на весь пакет.
+    Ошибка валидации любого элемента отклоняет весь пакет (422, проверяет FastAPI);
+    элементы с временем не в будущем получают error, остальные планируются.
+    Ошибка планировщика или БД откатывает весь пакет (500).
+    """
+    sched = scheduler.get_scheduler()
+    if not sched or not sched.running:
+         logger.error("Scheduler is not running or not initialized.")
+         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Scheduler service is unavailable")
+
+    now = datetime.now(timezone.utc)
+    results = []
+    rows = []
+    for item in request.items:
+        try:
+            run_date_dt = _run_date_for(item, now)
+        except ValueError as e:
+            results.append(models.ScheduleBatchItemResult(error=str(e)))
+            continue
+        row = _message_job_row(account_id, item, run_date_dt)
+        rows.append(row)
+        results.append(models.ScheduleBatchItemResult(job_id=row[1]))
+
+    try:
+        if rows:
+            await _schedule_jobs(sched, rows)
+    except Exception as e:
+        logger.error(f"Error adding batch of jobs to scheduler: {e}", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to schedule tasks: {e}")
+
+    logger.info(f"Scheduled {sum(r.job_id is not None for r in results)} of {len(results)} batch job(s) for account {account_id}")
+    return models.ScheduleBatchResponse(results=results)
+
+
 @app.get("/api/schedules",
          response_model=List[models.ScheduledTaskInfo], # Должна быть определена в models.py
          summary="Get Scheduled Tasks",
@@ -240,40 +330,30 @@ async def schedule_message(
 async def get_scheduled_tasks(
     account_id: int = Depends(security.get_account_id_from_secret) # Зависимость для аутентификации
 ):
-    """Возвращает список запланированных задач для пользователя."""
-    sched = scheduler.get_scheduler()
-    if not sched:
-        logger.error("Scheduler is not initialized.")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Scheduler service is unavailable")
-
-    tasks_info = []
+    """
+    Возвращает список запланированных задач для пользователя.
+    Задачи читаются из индекса account_jobs одним запросом по account_id,
+    без загрузки и распаковки задач APScheduler.
+    Строки уже имеют форму ScheduledTaskInfo, поэтому ответ собирается из словарей
+    и отдается ORJSONResponse напрямую - без создания моделей и повторной валидации response_model.
+    """
     try:
-        jobs = sched.get_jobs()
-        for job in jobs:
-            # Фильтруем задачи по account_id, который мы сохранили в kwargs при создании задачи
-            if job.kwargs.get('account_id') == account_id:
-                # scheduled_at = job.trigger.run_date if hasattr(job.trigger, 'run_date') else None # Для trigger='date'
-                next_run = job.next_run_time # Это время уже должно быть в UTC, т.к. APScheduler работает с UTC
-
-                # Превью сообщения для ответа
-                message_preview = str(job.kwargs.get('message', '')) # Преобразуем в строку на всякий случай
-                if len(message_preview) > 50:
-                    message_preview = message_preview[:50] + "..."
-
-                # Собираем информацию о задаче
-                tasks_info.append(models.ScheduledTaskInfo(
-                    job_id=job.id,
-                    recipient_id=str(job.kwargs.get('recipient_id', '?')), # Преобразуем в строку
-                    message_preview=message_preview,
-                    # Время возвращается в UTC ISO формате, клиент его преобразует
-                    next_run_time_iso=next_run.isoformat(timespec='milliseconds').replace('+00:00', 'Z') if next_run else "N/A",
-                    status="PENDING" # APScheduler сам не хранит статус PENDING/SENT/ERROR, это нужно реализовывать отдельно, если требуется
-                ))
+        tasks_info = [
+            {
+                "job_id": job_id,
+                "recipient_id": recipient_id,
+                "message_preview": message_preview,
+                # Время хранится и возвращается в UTC ISO формате, клиент его преобразует
+                "next_run_time_iso": run_date or "N/A",
+                "status": "PENDING", # APScheduler сам не хранит статус PENDING/SENT/ERROR, это нужно реализовывать отдельно, если требуется
+            }
+            for job_id, recipient_id, message_preview, run_date in await database.get_account_jobs(account_id)
+        ]
     except Exception as e:
-        logger.error(f"Error retrieving jobs from scheduler: {e}", exc_info=True)
+        logger.error(f"Error retrieving jobs for account {account_id}: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to retrieve scheduled tasks: {e}")
 
-    return tasks_info
+    return ORJSONResponse(content=tasks_info)
 
 
 @app.delete("/api/schedules/{job_id}",
@@ -298,17 +378,25 @@ async def delete_scheduled_task(
          raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Scheduler service is unavailable")
 
     try:
-        job = sched.get_job(job_id) # Попытка получить задачу
+        # Владелец закодирован в ID задачи; для ID старого формата берем его из индекса account_jobs
+        owner_id = _job_owner_from_id(job_id)
+        if owner_id is None:
+            owner_id = await database.get_account_job_owner(job_id)
 
-        if job is not None:
+        if owner_id is not None:
             # Задача найдена, проверяем владение
-            if job.kwargs.get('account_id') != account_id:
-                logger.warning(f"Account {account_id} attempted to delete job {job_id} owned by account {job.kwargs.get('account_id')}")
+            if owner_id != account_id:
+                logger.warning(f"Account {account_id} attempted to delete job {job_id} owned by account {owner_id}")
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to delete this task")
 
-            # Владение подтверждено, удаляем задачу
-            sched.remove_job(job_id)
-            logger.info(f"Removed job {job_id} for account {account_id}")
+            # Владение подтверждено, удаляем задачу: сначала постоянную копию, затем из планировщика
+            await database.delete_account_jobs([job_id])
+            try:
+                sched.remove_job(job_id)
+                logger.info(f"Removed job {job_id} for account {account_id}")
+            except JobLookupError:
+                # Задача успела выполниться и удалиться между проверкой и удалением
+                logger.info(f"Job {job_id} was already gone when deleting (account {account_id}). Treating as success (204).")
         else:
              # Задача не найдена, это не ошибка для DELETE (идемпотентность)
              logger.info(f"Attempted to delete non-existent job {job_id} (account {account_id}). Treating as success (204).")
@@ -316,14 +404,44 @@ async def delete_scheduled_task(
         # Успешное удаление или отсутствие задачи -> возвращаем 204
         return None # FastAPI автоматически вернет 204
 
+    except HTTPException:
+        raise # 403 выше не должен превращаться в 500
     except Exception as e: # Ловим прочие ошибки планировщика
         logger.error(f"Error removing job {job_id}: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to remove scheduled task: {e}")
 
 
 # --- НОВЫЙ ЭНДПОИНТ ДЛЯ ЗАГРУЗКИ ЧАТОВ ---
+# Микро-кэш списка диалогов: UI опрашивает эндпоинт, и повторные запросы
+# в пределах окна не ходят в VK. Ключ - (account_id, offset, count).
+CONVERSATIONS_CACHE_TTL = 10 # секунд
+_CONV_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=CONVERSATIONS_CACHE_TTL)
+# Блокировка на ключ, чтобы одновременные промахи делали один запрос к VK.
+# Слабые ссылки: блокировка живет, пока ее кто-то ждет.
+_conv_locks: "weakref.WeakValueDictionary[Tuple[int, int, int], asyncio.Lock]" = weakref.WeakValueDictionary()
+_CONV_CACHE_CONTROL = f"private, max-age={CONVERSATIONS_CACHE_TTL}"
+
+async def _fetch_conversations_cached(account_id: int, vk_token: str, offset: int, count: int):
+    """Возвращает результат vk_api.fetch_conversations, кэшируя успешные ответы на CONVERSATIONS_CACHE_TTL."""
+    key = (account_id, offset, count)
+    result = _CONV_CACHE.get(key)
+    if result is not None:
+        return result
+
+    lock = _conv_locks.get(key)
+    if lock is None:
+        lock = _conv_locks[key] = asyncio.Lock()
+    async with lock:
+        # Пока ждали блокировку, кэш мог заполнить другой запрос
+        result = _CONV_CACHE.get(key)
+        if result is None:
+            result = await vk_api.fetch_conversations(token=vk_token, offset=offset, count=count)
+            if result is not None: # Ошибки VK не кэшируем
+                _CONV_CACHE[key] = result
+    return result
+
 @app.get("/api/vk/conversations",
-         response_model=models.GetConversationsResponse, # Должна быть определена в models.py
+         response_model=models.ConversationListResponse,
          summary="Get VK Conversations",
          description="Retrieves a paginated list of user's VK conversations.",
          responses={
@@ -332,6 +450,8 @@ async def delete_scheduled_task(
              500: {"model": models.ErrorResponse, "description": "Internal Server Error"}
          })
 async def get_vk_conversations_paginated(
+    request: Request,
+    response: Response,
     offset: int = Query(0, ge=0, description="Number of conversations to skip"),
     count: int = Query(10, ge=1, le=50, description="Number of conversations to return (max 50)"), # Ограничиваем count
     # Используем новую зависимость для получения токена
@@ -339,14 +459,17 @@ async def get_vk_conversations_paginated(
 ):
     """
     Возвращает постраничный список диалогов/бесед пользователя VK.
+    Ответы кэшируются на CONVERSATIONS_CACHE_TTL секунд по (account_id, offset, count).
     """
     try:
         # Вызываем функцию из модуля vk_api для получения данных
         # Эта функция должна обрабатывать ошибки VK API внутри себя
-        result = await vk_api.fetch_conversations(
-            token=vk_token,
-            offset=offset,
-            count=count
+        # account_id сохранен зависимостью get_vk_token_from_secret
+        result = await _fetch_conversations_cached(
+            request.state.account_id,
+            vk_token,
+            offset,
+            count
         )
 
         if result is None:
@@ -360,9 +483,10 @@ async def get_vk_conversations_paginated(
 
         # Распаковываем результат (список чатов и общее количество)
         conversation_items, total_count = result
+        response.headers["Cache-Control"] = _CONV_CACHE_CONTROL
 
         # Формируем ответ в соответствии с моделью Pydantic
-        return models.GetConversationsResponse(
+        return models.ConversationListResponse(
             items=conversation_items,
             total_count=total_count
         )
@@ -379,15 +503,22 @@ async def get_vk_conversations_paginated(
 # --- Запуск сервера (если файл запускается напрямую) ---
 if __name__ == "__main__":
     # Запуск с авто-перезагрузкой для разработки: uvicorn main_server:app --reload
-    # Для продакшена используется Gunicorn или другой ASGI сервер
+    # Для продакшена: RELOAD=false. Воркер всегда один: задачи планировщика хранятся в памяти
+    # процесса (см. lifespan), несколько воркеров отправляли бы каждое сообщение несколько раз.
     host = os.getenv("HOST", "127.0.0.1")
     port = int(os.getenv("PORT", "8000"))
-    reload_flag = os.getenv("RELOAD", "true").lower() == "true" # Перезагрузка по умолчанию включена
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        sys.exit(SINGLE_WORKER_ERROR)
+    reload_flag = os.getenv("RELOAD", "true").lower() == "true"
+
+    # uvloop (event loop на libuv) и httptools (C-парсер HTTP) быстрее стандартных asyncio/h11.
+    # uvloop не поддерживает Windows - там uvicorn сам выберет реализацию ("auto").
+    loop_impl = "auto" if sys.platform == "win32" else "uvloop"
 
-    print(f"Starting server with Uvicorn on {host}:{port}...")
+    print(f"Starting server with Uvicorn on {host}:{port} (loop={loop_impl}, http=httptools)...")
     if reload_flag:
         print("Reloading is enabled.")
-        uvicorn.run("main_server:app", host=host, port=port, reload=True)
+        uvicorn.run("main_server:app", host=host, port=port, reload=True, loop=loop_impl, http="httptools")
     else:
          print("Reloading is disabled.")
-         uvicorn.run(app, host=host, port=port) # Для запуска без reload нужно передать сам app объект
+         uvicorn.run(app, host=host, port=port, loop=loop_impl, http="httptools") # Для запуска без reload нужно передать сам app объект
@@ -1,13 +1,17 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from apscheduler.job import Job
 from pytz import utc
+from datetime import datetime
 import logging
+import pickle
+from typing import Optional
 
-from database import DATABASE_URL # Абсолютный импорт
+import database
 from vk_api import send_vk_message # Абсолютный импорт
-from security import get_decrypted_vk_token # Абсолютный импорт
+from security import get_decrypted_vk_token_async # Абсолютный импорт
 
 # Настраиваем логгер APScheduler
 logging.basicConfig(level=logging.INFO) # Устанавливаем общий уровень INFO
@@ -16,16 +20,116 @@ logger = logging.getLogger(__name__) # Логгер для нашего моду
 
 scheduler = None
 
-async def schedule_vk_message_job(account_id: int, recipient_id: str, message: str, job_id: str):
+# --- Задачи отправки сообщений ---
+# Планировщик держит задачи в памяти (MemoryJobStore), а постоянная копия каждой задачи -
+# строка таблицы account_jobs основной БД. При старте задачи восстанавливаются из нее.
+def message_preview(message: str) -> str:
+    """Первые 50 символов сообщения для списка задач."""
+    return message if len(message) <= 50 else message[:50] + "..."
+
+def format_run_time(run_time: Optional[datetime]) -> Optional[str]:
+    """UTC ISO-строка с миллисекундами и суффиксом Z (в таком виде время отдается клиенту)."""
+    if run_time is None:
+        return None
+    return run_time.astimezone(utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+def add_message_job(row: database.AccountJobRow) -> Job:
+    """Добавляет в планировщик задачу отправки сообщения по строке account_jobs."""
+    account_id, job_id, recipient_id, _, run_date, message = row
+    return scheduler.add_job(
+        schedule_vk_message_job, # Функция, которая будет выполнена
+        trigger='date', # Запуск один раз в указанную дату
+        # UTC ISO-строка с суффиксом Z: fromisoformat понимает Z только с Python 3.11
+        run_date=datetime.fromisoformat(run_date.replace('Z', '+00:00')),
+        id=job_id,
+        name=f"VKMsg_{account_id}_{recipient_id}_{job_id}", # Имя для логов
+        replace_existing=False, # Не заменять, если ID уже есть (маловероятно)
+        misfire_grace_time=60, # Время (в сек), в течение которого задача может быть запущена после просрочки
+        # Передаем аргументы в функцию задачи schedule_vk_message_job
+        kwargs={
+            'account_id': account_id, # ID аккаунта из нашей БД
+            'recipient_id': recipient_id,
+            'message': message,
+            'job_id': job_id # Передаем ID самой задаче для логирования
+        }
+    )
+
+class AccountMemoryJobStore(MemoryJobStore):
     """
-    Функция, которую выполняет APScheduler для отправки сообщения VK.
+    MemoryJobStore, постоянная копия задач которого - таблица account_jobs.
+    Строки записывает main_server до add_job; задачи, удаленные из планировщика
+    (в т.ч. выполненные), убираются из таблицы в фоне, не блокируя цикл событий.
     """
+
+    def remove_job(self, job_id):
+        super().remove_job(job_id)
+        database.delete_account_jobs_in_background([job_id])
+
+    def remove_all_jobs(self):
+        job_ids = [job.id for job in self.get_all_jobs()]
+        super().remove_all_jobs()
+        database.delete_account_jobs_in_background(job_ids)
+
+    def shutdown(self):
+        # MemoryJobStore.shutdown вызывает remove_all_jobs; таблица account_jobs
+        # при остановке должна сохраниться, поэтому очищаем только память
+        MemoryJobStore.remove_all_jobs(self)
+
+def _import_legacy_jobs():
+    """
+    Однократно переносит задачи прежнего SQLAlchemyJobStore (таблица apscheduler_jobs)
+    в account_jobs вместе с текстом сообщения и удаляет эту таблицу.
+    """
+    states = database.get_legacy_scheduler_jobs()
+    if states is None:
+        return
+    rows = []
+    for job_id, job_state in states:
+        try:
+            state = pickle.loads(job_state)
+        except Exception as e:
+            logger.error(f"[Job {job_id}] Could not unpickle legacy job, dropping it: {e}")
+            continue
+        kwargs = state.get('kwargs', {})
+        if kwargs.get('account_id') is None:
+            continue
+        message = str(kwargs.get('message', ''))
+        run_time = state.get('next_run_time') or getattr(state.get('trigger'), 'run_date', None)
+        rows.append((
+            kwargs['account_id'], job_id, str(kwargs.get('recipient_id', '?')),
+            kwargs.get('message_preview') or message_preview(message), format_run_time(run_time), message,
+        ))
+    database.import_legacy_scheduler_jobs(rows)
+    logger.info(f"Imported {len(rows)} job(s) from the legacy apscheduler_jobs table.")
+
+def restore_jobs():
+    """
+    Восстанавливает задачи планировщика из account_jobs. Вызывается при старте, до scheduler.start():
+    просроченные задачи планировщик выполнит или пропустит по misfire_grace_time.
+    """
+    _import_legacy_jobs()
+    restored = 0
+    for row in database.load_account_jobs():
+        if row[4] is None or row[5] is None:
+            logger.warning(f"[Job {row[1]}] Cannot restore job: no run date or message stored.")
+            continue
+        try:
+            add_message_job(row)
+        except Exception as e:
+            # Одна испорченная строка не должна мешать восстановлению остальных и запуску планировщика
+            logger.error(f"[Job {row[1]}] Could not restore job, skipping it: {e}")
+            continue
+        restored += 1
+    logger.info(f"Restored {restored} job(s) from account_jobs.")
+
+async def schedule_vk_message_job(account_id: int, recipient_id: str, message: str, job_id: str):
+    """Функция, которую выполняет APScheduler для отправки сообщения VK."""
     log_prefix = f"[Job {job_id}]"
     logger.info(f"{log_prefix} Running for account_id={account_id}, recipient_id={recipient_id}")
 
-    # Получаем и расшифровываем токен синхронно (т.к. security использует sqlite3)
-    # В идеале, если бы security был async, можно было бы использовать await asyncio.to_thread
-    decrypted_token = get_decrypted_vk_token(account_id)
+    # Промах кэша (sqlite3 + Fernet) уходит в поток, чтобы одновременно сработавшие задачи
+    # не блокировали цикл событий и отправку сообщений
+    decrypted_token = await get_decrypted_vk_token_async(account_id)
 
     if not decrypted_token:
         logger.error(f"{log_prefix} Error: Could not get/decrypt VK token for account_id {account_id}. Skipping job.")
@@ -83,12 +187,9 @@ def init_scheduler():
          # Можно попытаться его запустить или пересоздать
          # pass
 
-    # Используем синхронный URL для SQLAlchemyJobStore
-    sync_db_url = DATABASE_URL.replace("sqlite+aiosqlite", "sqlite")
-    logger.info(f"Using database URL for APScheduler JobStore: {sync_db_url}")
-
+    # Задачи в памяти; постоянная копия - таблица account_jobs (см. restore_jobs)
     jobstores = {
-        'default': SQLAlchemyJobStore(url=sync_db_url)
+        'default': AccountMemoryJobStore()
     }
     executors = {
         'default': AsyncIOExecutor()
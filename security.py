@@ -1,14 +1,26 @@
 import os
+import re
 import secrets
+import base64
+import hmac
 from cryptography.fernet import Fernet, InvalidToken
+try:
+    # Rust-реализация Fernet (PyO3): формат ключа и токенов тот же, расшифровка в разы быстрее.
+    # Необязательна (в requirements.txt - только для Linux x86_64, где есть готовые колеса):
+    # без нее используется cryptography
+    import rfernet
+except ImportError:
+    rfernet = None
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status
 from fastapi.security import APIKeyHeader
 import sqlite3
-from contextlib import closing
+import asyncio
+import threading
 import logging
+from cachetools import TTLCache
 
-from database import SYNC_DATABASE_PATH # Импортируем абсолютным путем
+import database
 
 logger = logging.getLogger(__name__)
 load_dotenv()
@@ -22,31 +34,84 @@ if not ENCRYPTION_KEY:
 try:
     # Проверяем, что ключ валидный для Fernet
     fernet = Fernet(ENCRYPTION_KEY.encode())
+    # rfernet принимает и возвращает токены как str, cryptography - как bytes
+    if rfernet is not None:
+        _rfernet = rfernet.Fernet(ENCRYPTION_KEY)
+
+        def _encrypt(data: bytes) -> str:
+            return _rfernet.encrypt(data)
+
+        def _decrypt(token: str) -> bytes:
+            return _rfernet.decrypt(token)
+
+        _INVALID_TOKEN_ERRORS = (InvalidToken, rfernet.DecryptionError)
+    else:
+        def _encrypt(data: bytes) -> str:
+            return fernet.encrypt(data).decode()
+
+        def _decrypt(token: str) -> bytes:
+            return fernet.decrypt(token.encode())
+
+        _INVALID_TOKEN_ERRORS = (InvalidToken,)
     logger.info("Encryption key loaded successfully.")
 except (ValueError, TypeError) as e:
      logger.critical(f"CRITICAL: Invalid ENCRYPTION_KEY format: {e}. Please generate a valid Fernet key.")
      raise ValueError("Некорректный формат ENCRYPTION_KEY.")
 
+def _cpu_has_aes() -> bool | None:
+    """
+    Проверяет по /proc/cpuinfo, есть ли у процессора аппаратный AES
+    (флаг "aes": AES-NI на x86_64, Crypto Extensions на ARMv8). None - если узнать нельзя.
+    """
+    try:
+        with open("/proc/cpuinfo", encoding="ascii", errors="ignore") as f:
+            for line in f:
+                key, sep, value = line.partition(":")
+                if sep and key.strip() in ("flags", "Features"):
+                    return "aes" in value.split()
+    except OSError:
+        pass
+    return None
+
+def _log_crypto_backend() -> None:
+    """Логирует, чем выполняется AES в Fernet, и предупреждает, если аппаратного AES нет."""
+    from cryptography.hazmat.backends.openssl import backend
+    logger.info(f"Fernet backend: {'rfernet' if rfernet is not None else 'cryptography'}, {backend.openssl_version_text()}")
+    if _cpu_has_aes() is False:
+        logger.warning("CPU does not report AES instructions: Fernet encryption/decryption will use software AES and be several times slower.")
+
+_log_crypto_backend()
+
 # --- Шифрование ---
 def encrypt_token(token: str) -> str:
     """Шифрует токен."""
     if not token:
         raise ValueError("Cannot encrypt an empty token")
     try:
-        return fernet.encrypt(token.encode()).decode()
+        return _encrypt(token.encode())
     except Exception as e:
         logger.error(f"Error encrypting token: {e}", exc_info=True)
         raise # Перебрасываем исключение, т.к. это критично
 
+# Токены, которые не расшифровались: повторные попытки в течение минуты
+# не тратят время на HMAC-проверку, исключение и запись в лог
+_INVALID_TOKEN_CACHE: "TTLCache[str, bool]" = TTLCache(maxsize=1024, ttl=60)
+_invalid_token_lock = threading.Lock()
+
 def decrypt_token(encrypted_token: str) -> str | None:
     """Расшифровывает токен. Возвращает None в случае ошибки."""
     if not encrypted_token:
         logger.warning("Attempted to decrypt an empty token string.")
         return None
+    with _invalid_token_lock:
+        if encrypted_token in _INVALID_TOKEN_CACHE:
+            return None
     try:
-        return fernet.decrypt(encrypted_token.encode()).decode()
-    except InvalidToken:
+        return _decrypt(encrypted_token).decode()
+    except _INVALID_TOKEN_ERRORS:
         logger.error("Error decrypting token: InvalidToken. The token may be corrupted or the key might have changed.")
+        with _invalid_token_lock:
+            _INVALID_TOKEN_CACHE[encrypted_token] = True
         return None
     except Exception as e:
         logger.error(f"Error decrypting token: {e}", exc_info=True)
@@ -57,6 +122,24 @@ def generate_client_secret() -> str:
     """Генерирует безопасный client_secret."""
     return secrets.token_urlsafe(32) # 32 байта = 43 символа в base64
 
+# --- Хэширование секрета ---
+# В БД хранится только HMAC-SHA256 от client_secret: поиск идет по хэшу, так что время
+# сравнения в SQLite не зависит от того, насколько присланный секрет похож на настоящий,
+# а утечка БД не раскрывает секреты. Ключ HMAC выводится из ENCRYPTION_KEY.
+_SECRET_HMAC_KEY = hmac.digest(base64.urlsafe_b64decode(ENCRYPTION_KEY), b"client_secret", "sha256")
+
+def hash_client_secret(client_secret: str) -> str:
+    """Возвращает HMAC-SHA256 от client_secret (hex) - значение, которое хранится в БД."""
+    return hmac.digest(_SECRET_HMAC_KEY, client_secret.encode(), "sha256").hex()
+
+# Формат, который выдает generate_client_secret (base64url), с запасом по длине.
+# Заведомо мусорные секреты отсекаются до кэша и БД.
+_SECRET_RE = re.compile(r"[A-Za-z0-9_\-]{32,64}")
+
+def is_well_formed_secret(client_secret: str) -> bool:
+    """Проверяет, что строка может быть client_secret, выданным generate_client_secret."""
+    return _SECRET_RE.fullmatch(client_secret) is not None
+
 # --- Аутентификация по заголовку ---
 # Ожидаем заголовок типа "Authorization: Secret <your_client_secret>"
 SECRET_HEADER_NAME = "Authorization"
@@ -66,7 +149,8 @@ secret_header = APIKeyHeader(name=SECRET_HEADER_NAME, scheme_name=SECRET_SCHEME,
 async def get_account_id_from_secret(header: str | None = Depends(secret_header)) -> int:
     """
     Зависимость FastAPI для проверки client_secret и получения account_id.
-    Использует синхронный доступ к БД SQLite.
+    Использует общий с get_vk_token_from_secret кэш аккаунтов (database.resolve_account):
+    повторные запросы не обращаются к SQLite, холодные - ровно один раз.
     """
     if header is None:
         logger.warning("Authentication failed: Authorization header missing.")
@@ -75,41 +159,24 @@ async def get_account_id_from_secret(header: str | None = Depends(secret_header)
             detail="Not authenticated: Authorization header missing",
         )
 
-    # Проверяем схему и извлекаем секрет
-    parts = header.split()
-    if len(parts) != 2 or parts[0] != SECRET_SCHEME:
+    # Проверяем схему и извлекаем секрет; partition вместо split(): один кортеж вместо списка подстрок
+    scheme, sep, client_secret = header.partition(' ')
+    if not sep or scheme != SECRET_SCHEME or not client_secret or ' ' in client_secret:
         logger.warning(f"Authentication failed: Invalid scheme or format in header: {header}")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication scheme. Expected 'Secret <token>'",
         )
-    client_secret = parts[1]
 
-    if not client_secret:
-         logger.warning("Authentication failed: Client secret is empty.")
+    if not is_well_formed_secret(client_secret):
+         logger.warning("Authentication failed: Client secret is empty or malformed.")
          raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid client secret",
         )
 
-    # Ищем секрет в БД (синхронно)
-    account_id = None
-    try:
-        # Используем with closing для гарантии закрытия соединения и курсора
-        with closing(sqlite3.connect(SYNC_DATABASE_PATH, timeout=5)) as conn: # Добавим таймаут
-            with closing(conn.cursor()) as cursor:
-                cursor.execute("SELECT id FROM accounts WHERE client_secret = ?", (client_secret,))
-                result = cursor.fetchone()
-                if result:
-                    account_id = result[0]
-                    # logger.debug(f"Authentication successful for client_secret ending in ...{client_secret[-6:]}, account_id: {account_id}")
-                # else:
-                    # logger.warning(f"Authentication failed: Client secret ending in ...{client_secret[-6:]} not found.")
-
-    except sqlite3.Error as e:
-        logger.error(f"Database error during authentication for secret ending ...{client_secret[-6:]}: {e}", exc_info=True)
-        # Не раскрываем детали БД клиенту
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Authentication database error")
+    account = await database.resolve_account(client_secret)
+    account_id = account[0] if account else None
 
     if account_id is None:
         raise HTTPException(
@@ -119,19 +186,21 @@ async def get_account_id_from_secret(header: str | None = Depends(secret_header)
     return account_id
 
 def get_decrypted_vk_token(account_id: int) -> str | None:
-    """Получает и расшифровывает VK токен для заданного account_id (синхронно)."""
+    """
+    Получает и расшифровывает VK токен для заданного account_id (синхронно).
+    Вызывается при срабатывании задачи; соединение берется из пула database, а не открывается заново.
+    """
     if not isinstance(account_id, int) or account_id <= 0:
         logger.warning(f"Attempted to get token for invalid account_id: {account_id}")
         return None
 
-    encrypted_token = None
+    # Токен аккаунта, недавно проходившего аутентификацию или привязку, уже расшифрован
+    cached = database.get_cached_account_token(account_id)
+    if cached is not None:
+        return cached
+
     try:
-        with closing(sqlite3.connect(SYNC_DATABASE_PATH, timeout=5)) as conn:
-            with closing(conn.cursor()) as cursor:
-                cursor.execute("SELECT encrypted_vk_token FROM accounts WHERE id = ?", (account_id,))
-                result = cursor.fetchone()
-                if result:
-                    encrypted_token = result[0]
+        encrypted_token = database.get_encrypted_token(account_id)
     except sqlite3.Error as e:
         logger.error(f"Database error getting encrypted token for account_id {account_id}: {e}", exc_info=True)
         return None # Не можем продолжить без токена
@@ -144,7 +213,18 @@ def get_decrypted_vk_token(account_id: int) -> str | None:
     if not decrypted:
          logger.error(f"CRITICAL: Failed to decrypt token for account_id: {account_id}. Check encryption key and token integrity.")
          # Возможно, стоит уведомить администратора или пометить аккаунт
-    # else:
-         # logger.debug(f"Successfully decrypted token for account_id: {account_id}")
+    else:
+        database.cache_account_token(account_id, decrypted)
 
     return decrypted
+
+async def get_decrypted_vk_token_async(account_id: int) -> str | None:
+    """
+    Асинхронный вариант get_decrypted_vk_token для вызова из цикла событий.
+    Закэшированный токен возвращается сразу; SELECT и расшифровка Fernet при промахе
+    выполняются в потоке, чтобы не блокировать одновременно работающие корутины.
+    """
+    cached = database.get_cached_account_token(account_id)
+    if cached is not None:
+        return cached
+    return await asyncio.to_thread(get_decrypted_vk_token, account_id)
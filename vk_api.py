@@ -2,148 +2,393 @@
 import httpx
 import asyncio
 import random
-from fastapi import HTTPException, status
+import orjson
+import re
+import weakref
+import hashlib
 import logging
-from typing import List, Dict, Any, Tuple, Optional # Добавлены типы
-
-# Импортируем модель из models.py (убедитесь, что путь правильный)
-try:
-    from models import ConversationItem
-except ImportError:
-    # Заглушка на случай проблем с импортом
-    class ConversationItem:
-        def __init__(self, peer_id: int, title: str):
-            self.peer_id = peer_id
-            self.title = title
+from urllib.parse import urlencode
+from typing import List, Dict, Any, Tuple, Optional, NamedTuple # Добавлены типы
+from cachetools import TTLCache
 
 logger = logging.getLogger(__name__)
 
 VK_API_VERSION = "5.199" # Используйте актуальную версию
 VK_API_URL = "https://api.vk.com/method/"
 
+# Один клиент на процесс: соединения с api.vk.com (TCP + TLS) переиспользуются между вызовами,
+# а по HTTP/2 параллельные запросы идут через одно соединение.
+# Таймаут по умолчанию - для отправки; validate_vk_token задает свой.
+_client: Optional[httpx.AsyncClient] = None
+
+def _get_client() -> httpx.AsyncClient:
+    """Возвращает общий httpx.AsyncClient, создавая его при первом обращении."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=VK_API_URL, # Методы API передаются относительными путями ("messages.send")
+            # Версия API одна на все методы: httpx добавляет ее к каждому запросу,
+            # отдельный словарь params на вызов не собирается
+            params={"v": VK_API_VERSION},
+            http2=True,
+            timeout=15.0,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        )
+    return _client
+
+_warm_up_task: Optional[asyncio.Task] = None
+
+async def _open_connection() -> None:
+    try:
+        # Любой HTTP-ответ подходит: важно лишь установить TCP + TLS соединение в пуле клиента
+        await _get_client().head("", timeout=5.0)
+        logger.info("VK API connection warmed up.")
+    except httpx.HTTPError as e:
+        logger.warning(f"Could not warm up VK API connection: {e}")
+
+def warm_up() -> None:
+    """
+    Заранее открывает соединение с api.vk.com в фоне (вызывается из lifespan при старте),
+    чтобы первый запрос к VK не ждал TCP- и TLS-рукопожатия. Старт приложения не блокирует.
+    """
+    global _warm_up_task
+    _warm_up_task = asyncio.get_running_loop().create_task(_open_connection())
+
+async def shutdown() -> None:
+    """Закрывает общий клиент (вызывается из lifespan при остановке приложения)."""
+    global _client, _warm_up_task
+    if _warm_up_task is not None:
+        _warm_up_task.cancel()
+        _warm_up_task = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# Результаты validate_vk_token: токен -> user_id VK не меняется за время жизни токена.
+# Ключ - хэш токена, чтобы не держать сами токены в кэше. Кэшируются только успешные проверки;
+# ошибки авторизации (коды 5, 10) при отправке сообщений сбрасывают запись.
+VALIDATED_TOKEN_TTL = 300 # секунды
+_validated_tokens: "TTLCache[bytes, int]" = TTLCache(maxsize=10_000, ttl=VALIDATED_TOKEN_TTL)
+_TOKEN_REVOKED_CODES = frozenset({5, 10})
+# Ошибки токена/доступа: User authorization failed, permission denied, internal server error (captcha?),
+# invalid user id, app needs confirmation. Коды: https://dev.vk.com/reference/errors
+_AUTH_ERROR_CODES = frozenset({5, 7, 10, 15, 17, 28, 113})
+
+def _token_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
 async def validate_vk_token(token: str) -> Optional[int]:
     """
     Проверяет токен VK, обращаясь к users.get.
     Возвращает user_id, если токен валиден, иначе None.
+    Успешный результат кэшируется на VALIDATED_TOKEN_TTL секунд.
     """
     if not token:
         logger.warning("validate_vk_token called with empty token.")
         return None
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            logger.debug("Validating VK token...")
-            response = await client.post(
-                f"{VK_API_URL}users.get",
-                params={"access_token": token, "v": VK_API_VERSION}
-            )
-            response.raise_for_status() # Проверка на HTTP ошибки 4xx/5xx
-            data = response.json()
+    cache_key = _token_key(token)
+    cached_user_id = _validated_tokens.get(cache_key)
+    if cached_user_id is not None:
+        return cached_user_id
+
+    client = _get_client()
+    try:
+        logger.debug("Validating VK token...")
+        response = await client.post(
+            "users.get",
+            data={"access_token": token},
+            timeout=10.0,
+        )
+        # HTTP ошибки 4xx/5xx проверяем по статусу, без исключения из raise_for_status
+        if response.status_code >= 400:
+            logger.error(f"HTTP error validating VK token: status {response.status_code}")
+            return None
+        data = orjson.loads(response.content) # orjson быстрее stdlib json, особенно на списках диалогов
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"VK users.get response: {data}")
 
-            if "response" in data and data["response"] and isinstance(data["response"], list):
-                vk_user_id = data["response"][0].get("id")
-                if vk_user_id:
-                    logger.info(f"VK token validation successful for user_id: {vk_user_id}")
-                    return vk_user_id
-                else:
-                    logger.error("VK token validation error: 'id' not found in response.")
-                    return None
-            elif "error" in data:
-                 error_info = data['error']
-                 logger.error(f"VK API Error during token validation: {error_info.get('error_code')} - {error_info.get('error_msg')}")
-                 return None
+        if "response" in data and data["response"] and isinstance(data["response"], list):
+            vk_user_id = data["response"][0].get("id")
+            if vk_user_id:
+                logger.info(f"VK token validation successful for user_id: {vk_user_id}")
+                _validated_tokens[cache_key] = vk_user_id
+                return vk_user_id
             else:
-                 logger.error(f"Unknown VK API response structure during token validation: {data}")
-                 return None
-        except httpx.TimeoutException:
-            logger.error("Timeout error validating VK token.")
-            return None
-        except httpx.RequestError as e:
-            logger.error(f"HTTP error validating VK token: {e}", exc_info=True)
-            return None
-        except Exception as e:
-             logger.error(f"Unexpected error validating VK token: {e}", exc_info=True)
+                logger.error("VK token validation error: 'id' not found in response.")
+                return None
+        elif "error" in data:
+             error_info = data['error']
+             logger.error(f"VK API Error during token validation: {error_info.get('error_code')} - {error_info.get('error_msg')}")
+             return None
+        else:
+             logger.error(f"Unknown VK API response structure during token validation: {data}")
              return None
+    except httpx.TimeoutException:
+        logger.error("Timeout error validating VK token.")
+        return None
+    except httpx.RequestError as e:
+        logger.error(f"HTTP error validating VK token: {e!r}")
+        return None
+    except (orjson.JSONDecodeError, TypeError, AttributeError) as e:
+        # Тело не JSON или JSON не той формы. Прочие исключения - ошибки в коде: их логирует FastAPI
+        logger.error(f"Malformed VK response during token validation: {e}")
+        return None
+
+
+# Повторы отправки при временных ошибках VK (HTTP 429/5xx, коды 6 и 9 - слишком много запросов
+# и flood control): паузы VK_RETRY_BASE_DELAY * 2**attempt со случайным разбросом ±50%,
+# чтобы отправки, упершиеся в лимит одновременно, не повторялись тоже одновременно
+VK_SEND_ATTEMPTS = 3
+VK_RETRY_BASE_DELAY = 0.5 # секунды
+_RATE_LIMIT_CODES = frozenset({6, 9})
+
+def _retry_delay(attempt: int) -> float:
+    return VK_RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+
+# Token bucket на токен: не больше VK_REQUESTS_PER_SECOND отправок в секунду, чтобы
+# не тратить запросы на заведомую ошибку 6. Значение - (доступно запросов, время пополнения).
+VK_REQUESTS_PER_SECOND = 3
+_rate_buckets: "TTLCache[bytes, Tuple[float, float]]" = TTLCache(maxsize=4096, ttl=60)
 
+async def _acquire_rate_slot(token: str) -> None:
+    """Ждет, пока в корзине токена появится запрос, и забирает его."""
+    key = _token_key(token)
+    loop = asyncio.get_running_loop()
+    while True:
+        now = loop.time()
+        tokens, last_refill = _rate_buckets.get(key, (VK_REQUESTS_PER_SECOND, now))
+        tokens = min(VK_REQUESTS_PER_SECOND, tokens + (now - last_refill) * VK_REQUESTS_PER_SECOND)
+        if tokens >= 1:
+            _rate_buckets[key] = (tokens - 1, now)
+            return
+        _rate_buckets[key] = (tokens, now)
+        await asyncio.sleep((1 - tokens) / VK_REQUESTS_PER_SECOND)
+
+# Одновременных запросов к VK с одним токеном (лимит VK для пользовательских токенов - 3 запроса/с).
+# Семафор свой у каждого токена: отправки разных пользователей друг друга не ждут.
+# Ключ - _token_key(token), как у _validated_tokens и _rate_buckets: сами токены не хранятся.
+VK_PARALLEL_REQUESTS = 3
+_token_semaphores: "weakref.WeakValueDictionary[bytes, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+
+def _token_semaphore(token: str) -> asyncio.Semaphore:
+    key = _token_key(token)
+    semaphore = _token_semaphores.get(key)
+    if semaphore is None:
+        semaphore = _token_semaphores[key] = asyncio.Semaphore(VK_PARALLEL_REQUESTS)
+    return semaphore
+
+_FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
 
 async def send_vk_message(token: str, recipient_id: str, message: str, job_id: Optional[str] = None) -> Tuple[bool, Optional[int], Optional[str]]:
     """
     Отправляет сообщение через VK API.
     Возвращает (success: bool, vk_message_id: int | None, error_message: str | None)
+    Одновременно с одним токеном идет не более VK_PARALLEL_REQUESTS отправок (с учетом повторов).
+    """
+    async with _token_semaphore(token):
+        return await _send_vk_message(token, recipient_id, message, job_id)
+
+async def send_many(token: str, items: List[Tuple[str, str]]) -> List[Tuple[bool, Optional[int], Optional[str]]]:
     """
+    Отправляет сообщения (recipient_id, message) параллельно, в пределах лимита токена.
+    Возвращает результаты send_vk_message в порядке items.
+    """
+    return list(await asyncio.gather(*(send_vk_message(token, recipient_id, message) for recipient_id, message in items)))
+
+async def _send_vk_message(token: str, recipient_id: str, message: str, job_id: Optional[str]) -> Tuple[bool, Optional[int], Optional[str]]:
     log_prefix = f"[Job {job_id}] " if job_id else ""
     if not token or not recipient_id or not message:
         logger.error(f"{log_prefix}send_vk_message called with invalid parameters (empty token, recipient, or message).")
         return False, None, "Internal error: Invalid parameters for sending message."
 
     # Генерируем random_id для идемпотентности VK API
-    random_id = random.randint(0, 2**31 - 1)
-    params = {
+    random_id = random.getrandbits(31)
+    # Токен и текст идут в теле формы, а не в URL: не попадают в логи прокси и в текст
+    # исключений httpx, а длинное сообщение не упирается в ограничение длины URL (414)
+    # Тело кодируется один раз: при повторах (429/5xx, коды 6/9) длинный текст заново не экранируется
+    body = urlencode({
         "access_token": token,
-        "v": VK_API_VERSION,
         "peer_id": recipient_id,
         "message": message,
         "random_id": random_id,
         "dont_parse_links": 0 # 0 - создавать превью ссылок
-    }
+    }).encode()
     logger.info(f"{log_prefix}Attempting to send VK message to peer_id: {recipient_id} (random_id: {random_id})")
 
-    async with httpx.AsyncClient(timeout=15.0) as client: # Увеличим таймаут для отправки
+    client = _get_client()
+    for attempt in range(VK_SEND_ATTEMPTS):
         try:
-            response = await client.post(f"{VK_API_URL}messages.send", params=params)
-            # Логируем ответ VK API для отладки (первые 500 символов)
-            logger.debug(f"{log_prefix}VK messages.send response status: {response.status_code}, content: {response.text[:500]}")
+            await _acquire_rate_slot(token)
+            response = await client.post("messages.send", content=body, headers=_FORM_HEADERS)
+            # Логируем ответ VK API для отладки (первые 500 байт); без DEBUG тело не декодируется и не форматируется
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{log_prefix}VK messages.send response status: {response.status_code}, content: {response.content[:500].decode('utf-8', 'replace')}")
+
+            # 429/5xx - временная ошибка на стороне VK: повторяем с тем же random_id, дубля VK не создаст
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt + 1 < VK_SEND_ATTEMPTS:
+                    logger.warning(f"{log_prefix}VK returned HTTP {response.status_code} (messages.send), retrying (attempt {attempt + 1}/{VK_SEND_ATTEMPTS})")
+                    await asyncio.sleep(_retry_delay(attempt))
+                    continue
+            # Попытки исчерпаны или другая HTTP ошибка: тело - не ответ API, разбирать его незачем
+            if response.status_code >= 400:
+                logger.error(f"{log_prefix}VK returned HTTP {response.status_code} (messages.send) for peer_id {recipient_id}. Response: {response.content[:500].decode('utf-8', 'replace')}")
+                return False, None, f"VK HTTP {response.status_code}"
 
             # Не всегда VK возвращает ошибку с HTTP статусом > 400, иногда ошибка в теле JSON
-            data = response.json()
+            data = orjson.loads(response.content)
 
             if "response" in data:
                 # Ответ может быть числом (message_id) или объектом для бесед
                 message_id = data["response"]
                 logger.info(f"{log_prefix}VK message sent successfully to peer_id: {recipient_id}. VK Response: {message_id}")
-                # Вернем сам message_id как число, если это возможно
-                numeric_message_id = message_id if isinstance(message_id, int) else None
+                # Вернем сам message_id как число, если это возможно: для peer_id VK возвращает int
+                # (проверка класса, а не isinstance - заодно отсекает bool), объект - только для peer_ids
+                numeric_message_id = message_id if message_id.__class__ is int else (
+                    message_id.get("message_id") if isinstance(message_id, dict) else None
+                )
                 return True, numeric_message_id, None
             elif "error" in data:
                 error_info = data["error"]
                 error_msg = error_info.get("error_msg", "Unknown VK error")
                 error_code = error_info.get("error_code", -1)
+                if error_code in _RATE_LIMIT_CODES and attempt + 1 < VK_SEND_ATTEMPTS: # Too many requests / flood control
+                    logger.warning(f"{log_prefix}VK rate limit hit (messages.send), retrying (attempt {attempt + 1}/{VK_SEND_ATTEMPTS})")
+                    await asyncio.sleep(_retry_delay(attempt))
+                    continue
                 logger.error(f"{log_prefix}VK API Error (messages.send) for peer_id {recipient_id}: Code {error_code}, Msg: {error_msg}")
                 # Особо обрабатываем ошибки токена/авторизации
                 # Коды ошибок взяты из документации VK API: https://dev.vk.com/reference/errors
-                if error_code in [5, 7, 10, 15, 17, 113, 28]: # User authorization failed, permission denied, internal server error (captcha?), invalid user id, app needs confirmation
+                if error_code in _AUTH_ERROR_CODES:
                     logger.warning(f"{log_prefix}Authorization or permission error encountered (Code: {error_code}). Token might be invalid or require action.")
-                    pass
+                    if error_code in _TOKEN_REVOKED_CODES:
+                        _validated_tokens.pop(_token_key(token), None)
                 return False, None, f"VK Error {error_code}: {error_msg}"
             else:
-                 # Проверяем HTTP статус, если нет ни 'response', ни 'error'
-                 response.raise_for_status() # Вызовет исключение для 4xx/5xx, если они есть
-                 # Если статус < 400, но формат ответа неизвестен
+                 # Статус < 400 (проверен выше), но формат ответа неизвестен
                  logger.error(f"{log_prefix}Unknown VK API response structure (messages.send) for peer_id {recipient_id}: {data}")
                  return False, None, "Unknown VK API response"
 
         except httpx.TimeoutException:
              logger.error(f"{log_prefix}Timeout error sending VK message to peer_id {recipient_id}")
              return False, None, "Timeout sending message to VK"
-        except httpx.RequestError as e:
-            # Обрабатываем ошибки HTTP (включая те, что вызвал raise_for_status)
+        except httpx.HTTPError as e:
+            # Обрабатываем сетевые ошибки и ошибки протокола HTTP
             # Логируем тело ответа, если оно есть, для диагностики
             response_text = e.response.text[:500] if hasattr(e, 'response') and e.response else "N/A"
             logger.error(f"{log_prefix}HTTP error sending VK message to peer_id {recipient_id}: {e}. Response: {response_text}", exc_info=False) # exc_info=False, т.к. само 'e' содержит инфо
             return False, None, f"Network/HTTP error: {e}"
-        except Exception as e:
-            logger.error(f"{log_prefix}Unexpected error sending VK message to peer_id {recipient_id}: {e}", exc_info=True)
-            return False, None, f"Unexpected error: {e}"
+        except (orjson.JSONDecodeError, TypeError, AttributeError) as e:
+            # Тело не JSON или JSON не той формы. Прочие исключения - ошибки в коде: их логирует APScheduler
+            logger.error(f"{log_prefix}Malformed VK response (messages.send) for peer_id {recipient_id}: {e}")
+            return False, None, f"Malformed VK response: {e}"
 
 
+# --- Пакетные вызовы через execute ---
+# execute выполняет до 25 методов API на стороне VK за один HTTPS-запрос.
+VK_EXECUTE_MAX_CALLS = 25
+_VK_METHOD_RE = re.compile(r"[a-z]+\.[A-Za-z]+")
+
+async def vk_execute(token: str, calls: List[Tuple[str, Dict[str, Any]]]) -> Optional[List[Optional[Tuple[List[Any], List[Dict[str, Any]]]]]]:
+    """
+    Выполняет список вызовов (метод, параметры) через метод execute, по VK_EXECUTE_MAX_CALLS за запрос.
+    Возвращает по элементу на каждую порцию calls: (результаты в порядке вызовов, execute_errors) -
+    для неудавшегося вызова VK возвращает false, а подробности кладет в execute_errors, -
+    или None, если запрос порции не удался (сетевая ошибка, HTTP ошибка или ошибка самого execute).
+    Неудача одной порции не отменяет остальные: вызовы других порций VK уже выполнил.
+    Возвращает None при пустом токене.
+    """
+    if not token:
+        logger.warning("vk_execute called with empty token.")
+        return None
+    for method, _ in calls:
+        # Имя метода подставляется в код VKScript как есть
+        if not _VK_METHOD_RE.fullmatch(method):
+            raise ValueError(f"Invalid VK API method name: {method!r}")
+
+    return [
+        await _execute_chunk(token, calls[start:start + VK_EXECUTE_MAX_CALLS])
+        for start in range(0, len(calls), VK_EXECUTE_MAX_CALLS)
+    ]
+
+async def _execute_chunk(token: str, chunk: List[Tuple[str, Dict[str, Any]]]) -> Optional[Tuple[List[Any], List[Dict[str, Any]]]]:
+    code = "return [" + ",".join(
+        f"API.{method}({orjson.dumps(params).decode()})" for method, params in chunk
+    ) + "];"
+    try:
+        # execute - такой же запрос с этим токеном, что и messages.send: общие семафор и token bucket
+        async with _token_semaphore(token):
+            await _acquire_rate_slot(token)
+            response = await _get_client().post(
+                "execute",
+                data={"access_token": token, "code": code},
+            )
+        # HTTP ошибки 4xx/5xx проверяем по статусу: тело - не ответ API, разбирать его незачем
+        if response.status_code >= 400:
+            logger.error(f"VK returned HTTP {response.status_code} (execute, {len(chunk)} calls). Response: {response.content[:500].decode('utf-8', 'replace')}")
+            return None
+        data = orjson.loads(response.content)
+    except httpx.TimeoutException:
+        logger.error(f"Timeout error calling VK execute ({len(chunk)} calls).")
+        return None
+    except httpx.RequestError as e:
+        logger.error(f"HTTP error calling VK execute ({len(chunk)} calls): {e}", exc_info=False)
+        return None
+    except orjson.JSONDecodeError as e:
+        logger.error(f"Malformed VK response (execute, {len(chunk)} calls): {e}")
+        return None
+
+    if "response" not in data:
+        error_info = data.get("error", {})
+        logger.error(f"VK API Error (execute): Code {error_info.get('error_code', -1)}, Msg: {error_info.get('error_msg', data)}")
+        return None
+    return data["response"], data.get("execute_errors", [])
+
+async def send_vk_messages_batch(token: str, messages: List[Tuple[str, str, int]]) -> List[Tuple[bool, Optional[int], Optional[str]]]:
+    """
+    Отправляет несколько сообщений (recipient_id, message, random_id) через execute,
+    по VK_EXECUTE_MAX_CALLS за HTTPS-запрос.
+    Возвращает для каждого сообщения то же, что send_vk_message: (success, vk_message_id, error_message).
+    """
+    calls = [
+        ("messages.send", {"peer_id": recipient_id, "message": message, "random_id": random_id, "dont_parse_links": 0})
+        for recipient_id, message, random_id in messages
+    ]
+    executed = await vk_execute(token, calls)
+    if executed is None:
+        return [(False, None, "VK execute request failed")] * len(messages)
+
+    outcome: List[Tuple[bool, Optional[int], Optional[str]]] = []
+    for start, chunk_result in zip(range(0, len(messages), VK_EXECUTE_MAX_CALLS), executed):
+        if chunk_result is None:
+            # Не удался только запрос этой порции: сообщения остальных порций уже доставлены
+            outcome.extend([(False, None, "VK execute request failed")] * len(messages[start:start + VK_EXECUTE_MAX_CALLS]))
+            continue
+        results, errors = chunk_result
+        # VK возвращает false на месте неудавшегося вызова, а описания ошибок - по порядку в execute_errors
+        pending_errors = iter(errors)
+        for result in results:
+            if result is False:
+                error_info = next(pending_errors, {})
+                outcome.append((False, None, f"VK Error {error_info.get('error_code', -1)}: {error_info.get('error_msg', 'Unknown VK error')}"))
+            else:
+                outcome.append((True, result if isinstance(result, int) else None, None))
+    logger.info(f"Sent {sum(ok for ok, _, _ in outcome)} of {len(messages)} VK message(s) via execute")
+    return outcome
+
+
+class ConversationItem(NamedTuple):
+    """Диалог из messages.getConversations; поля совпадают с моделью models.ConversationItem."""
+    peer_id: int
+    title: str
+
 # --- ДОБАВЛЕННАЯ ФУНКЦИЯ ---
-async def fetch_conversations(token: str, offset: int, count: int) -> Optional[Tuple[List[Dict[str, Any]], int]]:
+async def fetch_conversations(token: str, offset: int, count: int) -> Optional[Tuple[List[ConversationItem], int]]:
     """
     Получает список диалогов пользователя из VK API с пагинацией.
-    Возвращает кортеж (список диалогов [словари], общее количество диалогов)
+    Возвращает кортеж (список диалогов [ConversationItem], общее количество диалогов)
     или None при ошибке (сетевой, API VK, или невалидный токен).
-    Формат словаря в списке соответствует модели models.ConversationItem.
     """
     if not token:
         logger.warning("fetch_conversations called with empty token.")
@@ -151,81 +396,111 @@ async def fetch_conversations(token: str, offset: int, count: int) -> Optional[T
 
     params = {
         'access_token': token,
-        'v': VK_API_VERSION,
         'offset': offset,
         'count': count,
         'extended': 0, # 0 - не возвращать профили/группы, только основную информацию о беседе
         'filter': 'all' # Получать все типы диалогов (личные, чаты, сообщества)
     }
-    url = f"{VK_API_URL}messages.getConversations"
     logger.info(f"Fetching VK conversations: offset={offset}, count={count}")
 
-    async with httpx.AsyncClient(timeout=15.0) as client: # Немного увеличим таймаут
-        try:
-            response = await client.get(url, params=params)
-            logger.debug(f"VK messages.getConversations response status: {response.status_code}, content: {response.text[:500]}")
-            data = response.json()
-
-            if 'response' in data:
-                vk_response = data['response']
-                items = vk_response.get('items', [])
-                total_count = vk_response.get('count', 0)
-
-                # Форматируем результат, чтобы он соответствовал ожиданиям клиента (модели ConversationItem)
-                formatted_items: List[Dict[str, Any]] = []
-                for item in items:
-                    conversation = item.get('conversation')
-                    if not conversation: continue # Пропускаем, если нет объекта conversation
-
-                    peer = conversation.get('peer')
-                    if not peer: continue # Пропускаем, если нет объекта peer
-
-                    peer_id = peer.get('id')
-                    if peer_id is None: continue # Пропускаем, если нет peer_id
-
-                    # Получаем title из chat_settings, если это чат
-                    chat_settings = conversation.get('chat_settings')
-                    title = chat_settings.get('title', f"Диалог ID {peer_id}") if chat_settings else f"Диалог ID {peer_id}"
-
-                    # TODO: Для личных диалогов (peer.type == 'user') можно было бы получить имя пользователя,
-                    # сделав 'extended': 1 и парся поле 'profiles'. Но для простоты пока используем ID.
-                    # Для сообществ (peer.type == 'group') аналогично с полем 'groups'.
-
-                    formatted_items.append({
-                        "peer_id": peer_id,
-                        "title": title
-                    })
-
-                logger.info(f"Successfully fetched {len(formatted_items)} conversations (offset={offset}, count={count}). Total reported by VK: {total_count}.")
-                return formatted_items, total_count
-
-            elif 'error' in data:
-                error_info = data['error']
-                error_msg = error_info.get('error_msg', 'Unknown VK error')
-                error_code = error_info.get('error_code', -1)
-                logger.error(f"VK API Error (messages.getConversations): Code {error_code}, Msg: {error_msg}")
-                 # Проверяем специфичные ошибки токена или доступа
-                if error_code in [5, 7, 10, 15, 17, 113, 28]:
-                     logger.warning(f"Authorization or permission error (Code: {error_code}) fetching conversations. Token may be invalid.")
-                     # Здесь НЕ возвращаем None сразу, позволяем main_server вернуть 400 Bad Request,
-                     # т.к. ошибка произошла на уровне VK API, а не аутентификации нашего сервера.
-                     # Если бы код 5 (User authorization failed) был 100% индикатором невалидности НАШЕГО секрета,
-                     # то можно было бы вернуть None, чтобы main_server выдал 401.
-                return None # Возвращаем None при любой ошибке VK API
+    client = _get_client()
+    try:
+        # Страницы расходуют тот же лимит токена (3 запроса/с), что и отправка сообщений
+        await _acquire_rate_slot(token)
+        response = await client.get("messages.getConversations", params=params)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"VK messages.getConversations response status: {response.status_code}, content: {response.content[:500].decode('utf-8', 'replace')}")
+        if response.status_code >= 400:
+            logger.error(f"HTTP error fetching VK conversations: status {response.status_code}")
+            return None
+        data = orjson.loads(response.content)
 
-            else:
-                 # Проверяем HTTP статус, если нет ни 'response', ни 'error'
-                 response.raise_for_status()
-                 logger.error(f"Unknown VK API response structure (messages.getConversations): {data}")
-                 return None
+        if 'response' in data:
+            vk_response = data['response']
+            items = vk_response.get('items', [])
+            total_count = vk_response.get('count', 0)
 
-        except httpx.TimeoutException:
-             logger.error(f"Timeout error fetching VK conversations.")
-             return None
-        except httpx.RequestError as e:
-             response_text = e.response.text[:500] if hasattr(e, 'response') and e.response else "N/A"
-             logger.error(f"HTTP error fetching VK conversations: {e}. Response: {response_text}", exc_info=False)
+            # Форматируем результат, чтобы он соответствовал ожиданиям клиента (модели ConversationItem)
+            # Один проход без промежуточных переменных цикла: пропускаем элементы без
+            # conversation / peer / peer_id, title берем из chat_settings, если это чат
+            # TODO: Для личных диалогов (peer.type == 'user') можно было бы получить имя пользователя,
+            # сделав 'extended': 1 и парся поле 'profiles'. Но для простоты пока используем ID.
+            # Для сообществ (peer.type == 'group') аналогично с полем 'groups'.
+            formatted_items: List[ConversationItem] = [
+                ConversationItem(
+                    peer_id,
+                    chat_settings.get('title', f"Диалог ID {peer_id}") if chat_settings else f"Диалог ID {peer_id}",
+                )
+                for item in items
+                if (conversation := item.get('conversation'))
+                and (peer := conversation.get('peer'))
+                and (peer_id := peer.get('id')) is not None
+                for chat_settings in (conversation.get('chat_settings'),)
+            ]
+
+            logger.info(f"Successfully fetched {len(formatted_items)} conversations (offset={offset}, count={count}). Total reported by VK: {total_count}.")
+            return formatted_items, total_count
+
+        elif 'error' in data:
+            error_info = data['error']
+            error_msg = error_info.get('error_msg', 'Unknown VK error')
+            error_code = error_info.get('error_code', -1)
+            logger.error(f"VK API Error (messages.getConversations): Code {error_code}, Msg: {error_msg}")
+             # Проверяем специфичные ошибки токена или доступа
+            if error_code in _AUTH_ERROR_CODES:
+                 logger.warning(f"Authorization or permission error (Code: {error_code}) fetching conversations. Token may be invalid.")
+                 # Здесь НЕ возвращаем None сразу, позволяем main_server вернуть 400 Bad Request,
+                 # т.к. ошибка произошла на уровне VK API, а не аутентификации нашего сервера.
+                 # Если бы код 5 (User authorization failed) был 100% индикатором невалидности НАШЕГО секрета,
+                 # то можно было бы вернуть None, чтобы main_server выдал 401.
+            return None # Возвращаем None при любой ошибке VK API
+
+        else:
+             # Статус < 400 (проверен выше), но нет ни 'response', ни 'error'
+             logger.error(f"Unknown VK API response structure (messages.getConversations): {data}")
              return None
-        except Exception as e:
-            logger.error(f"Unexpected error fetching VK conversations: {e}", exc_info=True)
-            return None
+
+    except httpx.TimeoutException:
+         logger.error(f"Timeout error fetching VK conversations.")
+         return None
+    except httpx.RequestError as e:
+         response_text = e.response.text[:500] if hasattr(e, 'response') and e.response else "N/A"
+         logger.error(f"HTTP error fetching VK conversations: {e}. Response: {response_text}", exc_info=False)
+         return None
+    except Exception as e:
+        logger.error(f"Unexpected error fetching VK conversations: {e}", exc_info=True)
+        return None
+
+
+# Максимальный count для messages.getConversations
+VK_CONVERSATIONS_PAGE_MAX = 200
+
+async def fetch_all_conversations(token: str, page: int = VK_CONVERSATIONS_PAGE_MAX) -> Optional[Tuple[List[ConversationItem], int]]:
+    """
+    Получает все диалоги пользователя: первая страница дает общее количество,
+    остальные запрашиваются параллельно (не более VK_PARALLEL_REQUESTS одновременно).
+    Возвращает (все диалоги, общее количество) или None, если не удалась хотя бы одна страница.
+    """
+    # Общий с отправкой сообщений лимит токена: семафор ограничивает одновременные запросы,
+    # а token bucket в fetch_conversations - запросы в секунду
+    semaphore = _token_semaphore(token)
+
+    async with semaphore:
+        first = await fetch_conversations(token, 0, page)
+    if first is None:
+        return None
+    first_items, total_count = first
+
+    async def fetch_page(offset: int) -> Optional[Tuple[List[ConversationItem], int]]:
+        async with semaphore:
+            return await fetch_conversations(token, offset, page)
+
+    pages = await asyncio.gather(*(fetch_page(offset) for offset in range(page, total_count, page)))
+    if any(result is None for result in pages):
+        return None
+
+    all_items = list(first_items)
+    for page_items, _ in pages:
+        all_items.extend(page_items)
+    return all_items, total_count
+